@@ -1,19 +1,82 @@
-from init_connection import MongoDBConnection
+from init_connection import MongoDBConnection, DEFAULT_BATCH_SIZE, USER_STATS_COLLECTION
+from indexes import IndexManager
+
+# Taille maximale de la liste des utilisateurs fréquents du rapport combiné :
+# la sortie d'un $facet est un document unique limité à 16 Mo
+DEFAULT_FREQUENT_LIMIT = 1000
+
+def print_aggregation_results(top_spenders, frequent_users, status_patterns, inactive_users):
+    """Affiche les quatre rapports principaux (pipelines synchrone et asynchrone)"""
+    print("1. Top 10 utilisateurs par montant total dépensé:")
+    print("-" * 50)
+    for idx, result in enumerate(top_spenders, 1):
+        print(f"{idx}. {result['first_name']} {result['last_name']}: {result['total_spent']:.2f}€")
+
+    print("\n2. Utilisateurs avec 3 transactions ou plus:")
+    print("-" * 50)
+    for idx, result in enumerate(frequent_users, 1):
+        print(f"{idx}. {result['first_name']} {result['last_name']}: {result['transaction_count']} transactions")
+
+    print("\n3. Analyse des statuts de transaction:")
+    print("-" * 50)
+    for result in status_patterns:
+        print(f"Status {result['_id']:<10}: {result['count']:>5} transactions, "
+              f"montant moyen: {result['avg_amount']:>8.2f}€")
+
+    print("\n4. Utilisateurs sans transactions:")
+    print("-" * 50)
+    for idx, result in enumerate(inactive_users, 1):
+        print(f"{idx}. {result['first_name']} {result['last_name']}")
 
 class DataAggregator:
-    def __init__(self):
-        self.mongo_conn = MongoDBConnection()
+    def __init__(self, index_policy='warn', mongo_conn=None, use_user_stats=False, cache=None):
+        self.mongo_conn = mongo_conn or MongoDBConnection()
         self.db = self.mongo_conn.connect()
+        # Lire les totaux et compteurs dans la vue matérialisée user_stats
+        # (voir UserStats.refresh) plutôt que de regrouper toutes les transactions
+        self.use_user_stats = use_user_stats
+        # QueryCache optionnel : les rapports sont alors retournés sous forme de listes
+        self.cache = cache
+        # 'fail' : refuse de démarrer si un index requis manque, 'warn' : avertit seulement
+        IndexManager(self.db).check_indexes(policy=index_policy)
+
+    def run_pipeline(self, collection, pipeline, **kwargs):
+        """Exécute une agrégation, ou lit son résultat dans le cache s'il est encore valide"""
+        if self.cache is None:
+            return self.db[collection].aggregate(pipeline, **kwargs)
+        return self.cache.get_or_compute(self.db, collection, pipeline,
+                                         lambda: list(self.db[collection].aggregate(pipeline, **kwargs)))
 
-    def total_spent_by_user(self):
-        """Tâche d'agrégation 1: Montant total dépensé par utilisateur"""
-        return self.db.transactions.aggregate([
+    @classmethod
+    def queries(cls):
+        """Pipelines des agrégations, par nom : {nom: (collection, pipeline)}"""
+        return {
+            'total_spent_by_user': ('transactions', cls.total_spent_by_user_pipeline()),
+            'users_with_multiple_transactions': ('transactions', cls.users_with_multiple_transactions_pipeline()),
+            'transaction_status_patterns': ('transactions', cls.transaction_status_patterns_pipeline()),
+            'users_without_transactions': ('users', cls.users_without_transactions_pipeline()),
+        }
+
+    @staticmethod
+    def total_spent_by_user_pipeline(limit=None, skip=0):
+        pipeline = [
+            # Le tri préalable permet un parcours couvert de l'index (user_id, amount)
+            {'$sort': {'user_id': 1}},
             {
                 '$group': {
                     '_id': '$user_id',
                     'total_spent': {'$sum': '$amount'}
                 }
             },
+            # Tri, skip et limit avant le $lookup : MongoDB fait un tri top-k
+            # et ne joint que les utilisateurs retournés
+            {'$sort': {'total_spent': -1}}
+        ]
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        return pipeline + [
             {
                 '$lookup': {
                     'from': 'users',
@@ -28,13 +91,56 @@ class DataAggregator:
                     'last_name': {'$arrayElemAt': ['$user_info.last_name', 0]},
                     'total_spent': 1
                 }
+            }
+        ]
+
+    def total_spent_by_user(self, limit=None, skip=0, batch_size=None):
+        """Tâche d'agrégation 1: Montant total dépensé par utilisateur
+
+        `limit`/`skip` paginent le classement côté serveur ; `batch_size`
+        règle la taille des lots du curseur pour le listing complet.
+        """
+        kwargs = {'batchSize': batch_size} if batch_size else {}
+        if self.use_user_stats:
+            return self.run_pipeline(USER_STATS_COLLECTION, self.total_spent_from_stats_pipeline(limit, skip), **kwargs)
+        return self.run_pipeline('transactions', self.total_spent_by_user_pipeline(limit, skip),
+                                 allowDiskUse=True, **kwargs)
+
+    @staticmethod
+    def total_spent_from_stats_pipeline(limit=None, skip=0):
+        """Classement lu dans user_stats : parcours de l'index total_spent, sans regroupement"""
+        pipeline = [{'$sort': {'total_spent': -1}}]
+        if skip:
+            pipeline.append({'$skip': skip})
+        if limit:
+            pipeline.append({'$limit': limit})
+        return pipeline + DataAggregator.user_name_stages('total_spent')
+
+    @staticmethod
+    def user_name_stages(*fields):
+        """Jointure des noms d'utilisateurs sur _id, en conservant les champs donnés"""
+        return [
+            {
+                '$lookup': {
+                    'from': 'users',
+                    'localField': '_id',
+                    'foreignField': '_id',
+                    'as': 'user_info'
+                }
             },
-            {'$sort': {'total_spent': -1}}
-        ])
+            {
+                '$project': {
+                    'first_name': {'$arrayElemAt': ['$user_info.first_name', 0]},
+                    'last_name': {'$arrayElemAt': ['$user_info.last_name', 0]},
+                    **{field: 1 for field in fields}
+                }
+            }
+        ]
 
-    def users_with_multiple_transactions(self):
-        """Tâche d'agrégation 2: Utilisateurs avec 3+ transactions"""
-        return self.db.transactions.aggregate([
+    @staticmethod
+    def users_with_multiple_transactions_pipeline():
+        return [
+            {'$sort': {'user_id': 1}},
             {
                 '$group': {
                     '_id': '$user_id',
@@ -61,10 +167,24 @@ class DataAggregator:
                     'transaction_count': 1
                 }
             }
-        ])
+        ]
 
-    def transaction_status_patterns(self):
-        return self.db.transactions.aggregate([
+    def users_with_multiple_transactions(self):
+        """Tâche d'agrégation 2: Utilisateurs avec 3+ transactions"""
+        if self.use_user_stats:
+            return self.run_pipeline(USER_STATS_COLLECTION, self.users_with_multiple_transactions_from_stats_pipeline())
+        return self.run_pipeline('transactions', self.users_with_multiple_transactions_pipeline(), allowDiskUse=True)
+
+    @staticmethod
+    def users_with_multiple_transactions_from_stats_pipeline(min_transactions=3):
+        return [
+            {'$match': {'transaction_count': {'$gte': min_transactions}}}
+        ] + DataAggregator.user_name_stages('transaction_count')
+
+    @staticmethod
+    def transaction_status_patterns_pipeline():
+        return [
+            {'$sort': {'status': 1}},
             {
                 '$group': {
                     '_id': '$status',
@@ -72,18 +192,48 @@ class DataAggregator:
                     'avg_amount': {'$avg': '$amount'}
                 }
             }
-        ])
+        ]
+
+    def transaction_status_patterns(self):
+        return self.run_pipeline('transactions', self.transaction_status_patterns_pipeline(), allowDiskUse=True)
 
-    def users_without_transactions(self):
-        return self.db.users.aggregate([
+    @staticmethod
+    def users_without_transactions_pipeline(mode='lookup'):
+        """Utilisateurs sans transaction.
+
+        'lookup' : anti-jointure dont la sous-requête ne lit qu'un user_id
+        (parcours couvert de l'index (user_id, amount)) et s'arrête à la
+        première transaction trouvée.
+        'stats' : anti-jointure sur l'_id de la vue user_stats (à jour après
+        UserStats.refresh()).
+        'full' : $lookup historique, qui matérialise toutes les transactions
+        de chaque utilisateur pour tester leur nombre.
+        """
+        if mode == 'full':
+            lookup = {
+                'from': 'transactions',
+                'localField': '_id',
+                'foreignField': 'user_id',
+                'as': 'transactions'
+            }
+        else:
+            from_stats = mode == 'stats'
+            lookup = {
+                'from': USER_STATS_COLLECTION if from_stats else 'transactions',
+                'localField': '_id',
+                'foreignField': '_id' if from_stats else 'user_id',
+                'pipeline': [{'$project': {'_id': 1} if from_stats else {'_id': 0, 'user_id': 1}},
+                             {'$limit': 1}],
+                'as': 'transactions'
+            }
+        return [
             {
-                '$lookup': {
-                    'from': 'transactions',
-                    'localField': '_id',
-                    'foreignField': 'user_id',
-                    'as': 'transactions'
+                '$project': {
+                    'first_name': 1,
+                    'last_name': 1
                 }
             },
+            {'$lookup': lookup},
             {
                 '$match': {
                     'transactions': {'$size': 0}
@@ -95,7 +245,164 @@ class DataAggregator:
                     'last_name': 1
                 }
             }
-        ])
+        ]
+
+    def users_without_transactions(self, mode=None):
+        """Tâche d'agrégation 4: Utilisateurs sans transactions (voir users_without_transactions_pipeline)"""
+        mode = mode or ('stats' if self.use_user_stats else 'lookup')
+        return self.run_pipeline('users', self.users_without_transactions_pipeline(mode))
+
+    @staticmethod
+    def time_window_match(start=None, end=None):
+        """Filtre [start, end[ sur timestamp, servi par l'index timestamp_1 ;
+        seules les dates BSON (transactions nettoyées) sont retenues"""
+        condition = {'$type': 'date'}
+        if start:
+            condition['$gte'] = start
+        if end:
+            condition['$lt'] = end
+        return {'$match': {'timestamp': condition}}
+
+    @staticmethod
+    def volume_by_period_pipeline(unit='day', start=None, end=None):
+        """Nombre de transactions et montant total par heure ('hour') ou par jour ('day')"""
+        return [
+            DataAggregator.time_window_match(start, end),
+            {
+                '$group': {
+                    '_id': {'$dateTrunc': {'date': '$timestamp', 'unit': unit}},
+                    'count': {'$sum': 1},
+                    'total_amount': {'$sum': '$amount'}
+                }
+            },
+            {'$sort': {'_id': 1}}
+        ]
+
+    def volume_by_period(self, unit='day', start=None, end=None, collection='transactions'):
+        """Volume par fenêtre de temps ; `collection` peut désigner la collection time-series"""
+        return self.run_pipeline(collection, self.volume_by_period_pipeline(unit, start, end), allowDiskUse=True)
+
+    @staticmethod
+    def amount_by_status_per_day_pipeline(start=None, end=None):
+        return [
+            DataAggregator.time_window_match(start, end),
+            {
+                '$group': {
+                    '_id': {
+                        'day': {'$dateTrunc': {'date': '$timestamp', 'unit': 'day'}},
+                        'status': '$status'
+                    },
+                    'count': {'$sum': 1},
+                    'total_amount': {'$sum': '$amount'},
+                    'avg_amount': {'$avg': '$amount'}
+                }
+            },
+            {'$sort': {'_id.day': 1, '_id.status': 1}}
+        ]
+
+    def amount_by_status_per_day(self, start=None, end=None, collection='transactions'):
+        """Montant par statut et par jour sur la fenêtre [start, end["""
+        return self.run_pipeline(collection, self.amount_by_status_per_day_pipeline(start, end), allowDiskUse=True)
+
+    @staticmethod
+    def combined_report_pipeline(top_n=10, min_transactions=3, frequent_limit=DEFAULT_FREQUENT_LIMIT):
+        """Total dépensé, utilisateurs fréquents et statuts en un seul parcours de transactions.
+
+        Un premier $group par (user_id, status) réduit les transactions à un
+        document par couple, puis $facet dérive les trois rapports de ce
+        résultat intermédiaire. La sortie d'un $facet est un document unique
+        limité à 16 Mo : chaque liste par utilisateur doit donc être bornée.
+        `top_n` borne les plus gros dépensiers et `frequent_limit` les
+        utilisateurs fréquents (triés par nombre de transactions décroissant,
+        puis par _id). Pour la liste complète des utilisateurs fréquents,
+        utiliser users_with_multiple_transactions(), lue par curseur.
+        """
+        if not top_n or not frequent_limit:
+            raise ValueError("top_n et frequent_limit doivent être positifs : la sortie de $facet est limitée à 16 Mo")
+        top_spenders = [
+            {'$group': {'_id': '$_id.user_id', 'total_spent': {'$sum': '$total'}}},
+            {'$sort': {'total_spent': -1}},
+            {'$limit': top_n}
+        ]
+        return [
+            {
+                '$group': {
+                    '_id': {'user_id': '$user_id', 'status': '$status'},
+                    'count': {'$sum': 1},
+                    'total': {'$sum': '$amount'},
+                    # $avg ignore les montants non numériques : on les exclut aussi du diviseur
+                    'amount_count': {'$sum': {'$cond': [{'$isNumber': '$amount'}, 1, 0]}}
+                }
+            },
+            {
+                '$facet': {
+                    'top_spenders': top_spenders,
+                    'frequent_users': [
+                        {'$group': {'_id': '$_id.user_id', 'transaction_count': {'$sum': '$count'}}},
+                        {'$match': {'transaction_count': {'$gte': min_transactions}}},
+                        {'$sort': {'transaction_count': -1, '_id': 1}},
+                        {'$limit': frequent_limit}
+                    ],
+                    'status_patterns': [
+                        {'$group': {
+                            '_id': '$_id.status',
+                            'count': {'$sum': '$count'},
+                            'total': {'$sum': '$total'},
+                            'amount_count': {'$sum': '$amount_count'}
+                        }},
+                        {'$project': {
+                            'count': 1,
+                            'avg_amount': {'$cond': [{'$gt': ['$amount_count', 0]},
+                                                     {'$divide': ['$total', '$amount_count']}, None]}
+                        }}
+                    ]
+                }
+            }
+        ]
+
+    def lookup_user_names(self, user_ids, batch_size=DEFAULT_BATCH_SIZE):
+        """Récupère {_id: (prénom, nom)} par requêtes $in groupées"""
+        user_ids = list(dict.fromkeys(user_ids))
+        names = {}
+        for i in range(0, len(user_ids), batch_size):
+            for user in self.db.users.find({'_id': {'$in': user_ids[i:i + batch_size]}},
+                                           {'first_name': 1, 'last_name': 1}):
+                names[user['_id']] = (user.get('first_name'), user.get('last_name'))
+        return names
+
+    def combined_report(self, top_n=10, min_transactions=3, frequent_limit=DEFAULT_FREQUENT_LIMIT):
+        """Rapport combiné : un parcours $facet des transactions puis une recherche groupée des noms"""
+        if self.cache is not None:
+            return self.cache.get_or_compute(
+                self.db, 'transactions', self.combined_report_pipeline(top_n, min_transactions, frequent_limit),
+                lambda: self.compute_combined_report(top_n, min_transactions, frequent_limit))
+        return self.compute_combined_report(top_n, min_transactions, frequent_limit)
+
+    def compute_combined_report(self, top_n=10, min_transactions=3, frequent_limit=DEFAULT_FREQUENT_LIMIT):
+        report = next(self.db.transactions.aggregate(
+            self.combined_report_pipeline(top_n, min_transactions, frequent_limit), allowDiskUse=True))
+        names = self.lookup_user_names(
+            [row['_id'] for row in report['top_spenders']] +
+            [row['_id'] for row in report['frequent_users']])
+        for key in ('top_spenders', 'frequent_users'):
+            for row in report[key]:
+                row['first_name'], row['last_name'] = names.get(row['_id'], (None, None))
+        return report
+
+    def run_combined_report(self, top_n=10, frequent_limit=DEFAULT_FREQUENT_LIMIT):
+        report = self.combined_report(top_n=top_n, frequent_limit=frequent_limit)
+
+        print(f"\n=== Top {top_n} des montants dépensés par utilisateur ===")
+        for result in report['top_spenders']:
+            print(f"{result['first_name']} {result['last_name']}: {result['total_spent']:.2f}")
+
+        print(f"\n=== Utilisateurs avec 3+ transactions ({frequent_limit} premiers) ===")
+        for result in report['frequent_users']:
+            print(f"{result['first_name']} {result['last_name']}: {result['transaction_count']} transactions")
+
+        print("\n=== Patterns des statuts de transaction ===")
+        for result in report['status_patterns']:
+            print(f"Status {result['_id']}: {result['count']} transactions, montant moyen: {result['avg_amount']:.2f}")
 
     def run_all_aggregations(self):
         print("\n=== Montant total dépensé par utilisateur ===")
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime
+from pymongo import AsyncMongoClient
+from pymongo.errors import BulkWriteError, OperationFailure
+from pymongo.server_api import ServerApi
+from tabulate import tabulate
+from init_connection import MongoDBConnection, DEFAULT_BATCH_SIZE, bump_load_generation, client_options, close_clients
+from data_cleaning import DataCleaner, INVALID_AMOUNT_FILTER, record_bulk_write, server_cleaning_update
+from aggregations import DataAggregator, print_aggregation_results
+from indexes import IndexManager
+
+# Nombre maximal d'opérations MongoDB lancées simultanément
+DEFAULT_CONCURRENCY = 4
+
+class AsyncDataPipeline:
+    """Variante asynchrone de DataPipeline (client asynchrone de PyMongo, 4.13+).
+
+    L'import reste séquentiel (les étapes suivantes en dépendent) et s'exécute
+    dans un thread. Le nettoyage des utilisateurs et celui des transactions
+    portent sur des collections distinctes et tournent en parallèle, avec les
+    règles, filtres et marquages de DataCleaner ; la validation des relations
+    les suit et reprend DataCleaner.validate_relationships dans un thread. Les
+    agrégations, indépendantes, sont lancées ensemble. Un sémaphore borne le
+    nombre d'opérations simultanées.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, batch_size=DEFAULT_BATCH_SIZE,
+                 cleaning_engine='python', streaming_import=True, import_workers=1, index_policy='warn',
+                 incremental_cleaning=False):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.cleaning_engine = cleaning_engine
+        self.incremental_cleaning = incremental_cleaning
+        self.streaming_import = streaming_import
+        self.import_workers = import_workers
+        self.index_policy = index_policy
+        self.semaphore = None
+        self.client = None
+        self.db = None
+        # DataCleaner synchrone : filtres de nettoyage et validation des relations
+        self.cleaner = None
+        self.timings = {}
+        self.current_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def print_section(self, title):
+        print("\n" + "="*80)
+        print(f" {title} ".center(80, "="))
+        print("="*80 + "\n")
+
+    async def timed(self, name, coro):
+        """Exécute une étape sous le sémaphore et enregistre sa durée"""
+        async with self.semaphore:
+            start = time.perf_counter()
+            try:
+                return await coro
+            finally:
+                self.timings[name] = time.perf_counter() - start
+
+    async def connect(self):
+        self.client = AsyncMongoClient(os.getenv('MONGODB_URI'), server_api=ServerApi('1'), **client_options())
+        await self.client.admin.command('ping')
+        self.db = self.client[os.getenv('DATABASE_NAME')]
+        print("✓ Connexion asynchrone établie avec succès")
+
+    def import_data(self):
+        """Import synchrone (streaming), exécuté hors de la boucle d'événements"""
+        mongo_conn = MongoDBConnection()
+        mongo_conn.connect()
+        json_path = os.path.join(self.current_dir, 'users_transactions_with_issues.json')
+        mongo_conn.import_data(json_path, streaming=self.streaming_import,
+                               batch_size=self.batch_size, workers=self.import_workers)
+        # L'import crée les index ; on vérifie ceux attendus par les agrégations
+        IndexManager(mongo_conn.db).check_indexes(policy=self.index_policy)
+        self.cleaner = DataCleaner(batch_size=self.batch_size, engine=self.cleaning_engine,
+                                   incremental=self.incremental_cleaning, mongo_conn=mongo_conn)
+
+    async def flush_updates(self, collection, operations, stats):
+        """Équivalent asynchrone de DataCleaner.flush_updates"""
+        if not operations:
+            return
+        try:
+            result = await collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            record_bulk_write(stats, collection.name, len(operations), error=e)
+        else:
+            record_bulk_write(stats, collection.name, len(operations), result=result)
+        operations.clear()
+
+    async def clean_collection(self, kind):
+        """Nettoyage document par document : lecture par curseur, écriture par lots"""
+        collection = self.db[kind]
+        operations = []
+        stats = {'batches': 0, 'modified': 0, 'errors': 0}
+        async for doc in collection.find(self.cleaner.cleaning_filter(kind), batch_size=self.batch_size):
+            operations.append(DataCleaner.cleaning_update(kind, doc))
+            if len(operations) >= self.batch_size:
+                await self.flush_updates(collection, operations, stats)
+        await self.flush_updates(collection, operations, stats)
+        return stats
+
+    async def clean_server_side(self, kind):
+        """Équivalent asynchrone de clean_users_server_side / clean_transactions_server_side"""
+        result = await self.db[kind].update_many(self.cleaner.cleaning_filter(kind), server_cleaning_update(kind))
+        return {'batches': 1, 'modified': result.modified_count, 'errors': 0}
+
+    async def clean(self, kind):
+        """Nettoie une collection avec le moteur configuré (repli sur le moteur Python)"""
+        try:
+            if kind == 'transactions':
+                await self.db.transactions.delete_many(INVALID_AMOUNT_FILTER)
+            if self.cleaning_engine == 'server':
+                try:
+                    return await self.clean_server_side(kind)
+                except OperationFailure as e:
+                    print(f"Nettoyage côté serveur impossible ({e}), repli sur le moteur Python")
+            return await self.clean_collection(kind)
+        finally:
+            await bump_load_generation(self.db)
+
+    async def clean_data(self):
+        self.print_section("ÉTAPE 2: Nettoyage des données (asynchrone)")
+        users_stats, transactions_stats = await asyncio.gather(
+            self.timed('clean_users', self.clean('users')),
+            self.timed('clean_transactions', self.clean('transactions')),
+        )
+        print(f"✓ Utilisateurs : {users_stats['modified']} modifiés, {users_stats['errors']} erreurs")
+        print(f"✓ Transactions : {transactions_stats['modified']} modifiées, {transactions_stats['errors']} erreurs")
+
+        # Étape seule à ce moment : la version synchrone suffit et invalide elle-même les caches
+        await self.timed('validate_relationships', asyncio.to_thread(self.cleaner.validate_relationships))
+
+    async def aggregate(self, collection, pipeline):
+        cursor = await self.db[collection].aggregate(pipeline, allowDiskUse=True)
+        return await cursor.to_list(None)
+
+    async def run_aggregations(self):
+        self.print_section("ÉTAPE 3: Analyses et Agrégations (asynchrones)")
+        queries = DataAggregator.queries()
+        queries['total_spent_by_user'] = ('transactions', DataAggregator.total_spent_by_user_pipeline(limit=10))
+        results = await asyncio.gather(*(
+            self.timed(name, self.aggregate(collection, pipeline))
+            for name, (collection, pipeline) in queries.items()
+        ))
+        results = dict(zip(queries, results))
+
+        print_aggregation_results(results['total_spent_by_user'], results['users_with_multiple_transactions'],
+                                  results['transaction_status_patterns'], results['users_without_transactions'])
+        return results
+
+    async def generate_report(self, elapsed_time):
+        self.print_section("RAPPORT FINAL")
+        users, transactions = await asyncio.gather(
+            self.db.users.estimated_document_count(),
+            self.db.transactions.estimated_document_count(),
+        )
+        print(f"Date d'exécution: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        print(f"Temps d'exécution total: {elapsed_time:.2f} secondes (concurrence: {self.concurrency})")
+        print("\nStatistiques finales:")
+        print("-" * 50)
+        print(f"Nombre d'utilisateurs: {users}")
+        print(f"Nombre de transactions: {transactions}")
+        print("\nDurée par étape:")
+        print(tabulate([[name, f"{duration:.3f}"] for name, duration in self.timings.items()],
+                       headers=['Étape', 'Durée (s)'], tablefmt='grid'))
+
+    async def run(self):
+        """Exécute le pipeline complet et retourne le temps total en secondes"""
+        start = time.perf_counter()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.timings = {}
+        try:
+            self.print_section("ÉTAPE 1: Connexion à MongoDB")
+            await self.connect()
+            print("\nImport des données initial...")
+            await self.timed('import', asyncio.to_thread(self.import_data))
+            print("✓ Import des données terminé")
+
+            await self.clean_data()
+            await self.run_aggregations()
+
+            elapsed = time.perf_counter() - start
+            await self.generate_report(elapsed)
+            return elapsed
+        finally:
+            if self.client is not None:
+                await self.client.close()
+            close_clients()
+
+def compare_with_sync(concurrency=DEFAULT_CONCURRENCY, cleaning_engine='python'):
+    """Exécute les pipelines synchrone puis asynchrone sur les mêmes données et compare leur durée.
+
+    Chaque pipeline réimporte le fichier JSON : ils partent du même état.
+    """
+    from main import DataPipeline
+
+    start = time.perf_counter()
+    DataPipeline(streaming_import=True, cleaning_engine=cleaning_engine).run()
+    sync_time = time.perf_counter() - start
+
+    async_time = asyncio.run(AsyncDataPipeline(concurrency=concurrency, cleaning_engine=cleaning_engine).run())
+
+    print("\n=== Comparaison synchrone / asynchrone ===")
+    print(tabulate([
+        ['synchrone', f"{sync_time:.2f}", '1.00x'],
+        [f'asynchrone (concurrence {concurrency})', f"{async_time:.2f}", f"{sync_time / async_time:.2f}x"],
+    ], headers=['Pipeline', 'Durée (s)', 'Accélération'], tablefmt='grid'))
+    return sync_time, async_time
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline MongoDB asynchrone")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="nombre maximal d'opérations simultanées")
+    parser.add_argument('--engine', choices=['python', 'server'], default='python',
+                        help="moteur de nettoyage")
+    parser.add_argument('--compare', action='store_true',
+                        help="exécute aussi le pipeline synchrone et compare les durées")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_with_sync(concurrency=args.concurrency, cleaning_engine=args.engine)
+    else:
+        asyncio.run(AsyncDataPipeline(concurrency=args.concurrency, cleaning_engine=args.engine).run())
+
+if __name__ == "__main__":
+    main()
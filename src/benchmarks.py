@@ -0,0 +1,280 @@
+import argparse
+import importlib.util
+import json
+import os
+import tempfile
+import time
+import pandas as pd
+from tabulate import tabulate
+from init_connection import MongoDBConnection, DEFAULT_BATCH_SIZE, get_client
+from data_cleaning import DataCleaner, clean_user_records
+from aggregations import DataAggregator
+from data_generator import generate_users, users_for_documents, write_dataset
+from user_stats import UserStats
+from metrics import percentile
+
+BENCHMARK_DATABASE = 'benchmark'
+
+def benchmark_user_cleaning(count=1_000_000):
+    """Compare le nettoyage document par document et le nettoyage vectorisé par lot"""
+    print(f"Génération de {count} utilisateurs synthétiques...")
+    users = generate_users(count)
+
+    start = time.perf_counter()
+    per_record = [DataCleaner.user_update_fields(user) for user in users]
+    per_record_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = clean_user_records(users)
+    batch_time = time.perf_counter() - start
+
+    # Données déjà en colonnes (DataFrame issu d'un export ou du notebook d'analyse)
+    frame = pd.DataFrame.from_records(users)
+    start = time.perf_counter()
+    clean_user_records(frame)
+    frame_time = time.perf_counter() - start
+
+    # Vérifier que les deux méthodes produisent les mêmes valeurs
+    mismatches = 0
+    for user, expected, row in zip(users, per_record, batch.itertuples(index=False)):
+        for field in ('email', 'phone', 'gender'):
+            if getattr(row, field) != expected[field]:
+                mismatches += 1
+        for field in ('first_name', 'last_name'):
+            if getattr(row, field) != expected.get(field, user[field]):
+                mismatches += 1
+
+    print(tabulate([
+        ['Par document (DataCleaner)', f'{per_record_time:.2f}', f'{count / per_record_time:,.0f}'],
+        ['Vectorisé, liste de dicts', f'{batch_time:.2f}', f'{count / batch_time:,.0f}'],
+        ['Vectorisé, DataFrame', f'{frame_time:.2f}', f'{count / frame_time:,.0f}'],
+    ], headers=['Méthode', 'Temps (s)', 'Utilisateurs/s'], tablefmt='grid'))
+    print(f"Accélération (liste): x{per_record_time / batch_time:.1f}")
+    print(f"Accélération (DataFrame): x{per_record_time / frame_time:.1f}")
+    print(f"Différences entre les deux méthodes: {mismatches}")
+    return {'per_record': per_record_time, 'batch': batch_time, 'frame': frame_time, 'mismatches': mismatches}
+
+def scanned_documents(db):
+    """Compteur serveur des documents examinés (None si serverStatus n'est pas autorisé)"""
+    try:
+        return db.command('serverStatus')['metrics']['queryExecutor']['scannedObjects']
+    except Exception:
+        return None
+
+def benchmark_aggregations(repeat=3):
+    """Compare les trois agrégations séparées sur transactions et le rapport combiné $facet"""
+    aggregator = DataAggregator()
+    try:
+        db = aggregator.db
+        transactions = db.transactions.estimated_document_count()
+        modes = {
+            'Séparées (3 agrégations)': (3, lambda: (list(aggregator.total_spent_by_user(limit=10)),
+                                                     list(aggregator.users_with_multiple_transactions()),
+                                                     list(aggregator.transaction_status_patterns()))),
+            'Combinée ($facet)': (1, lambda: aggregator.combined_report(top_n=10)),
+        }
+        rows = []
+        for label, (passes, run) in modes.items():
+            scanned_before = scanned_documents(db)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                run()
+            elapsed = (time.perf_counter() - start) / repeat
+            scanned_after = scanned_documents(db)
+            scanned = (scanned_after - scanned_before) // repeat if scanned_before is not None else 'n/a'
+            rows.append([label, passes, scanned, f'{elapsed:.3f}'])
+        print(f"Transactions: {transactions}")
+        print(tabulate(rows, headers=['Mode', 'Parcours de transactions', 'Documents examinés', 'Temps moyen (s)'],
+                       tablefmt='grid'))
+        return rows
+    finally:
+        aggregator.mongo_conn.close()
+
+def benchmark_connection(backend, uri=None, database=BENCHMARK_DATABASE):
+    """Connexion vers un mongod (URI, MONGODB_URI par défaut) ou vers mongomock (en mémoire)"""
+    if backend == 'mongomock':
+        if importlib.util.find_spec('mongomock') is None:
+            raise RuntimeError("mongomock n'est pas installé (pip install mongomock)")
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        client = get_client(uri)
+    mongo_conn = MongoDBConnection(client=client)
+    # Base dédiée : le benchmark supprime et recharge ses collections
+    mongo_conn.db = client[database]
+    return mongo_conn
+
+def run_pipeline_once(mongo_conn, dataset, samples, batch_size=DEFAULT_BATCH_SIZE, workers=1,
+                      engine='python', query_repeat=5, backend='mongod'):
+    """Un passage complet : import, étapes de clean_all, puis chaque agrégation `query_repeat` fois.
+
+    Ajoute à `samples[étape]` des tuples (durée, documents traités). Avec
+    mongomock, une étape qu'il n'implémente pas (NotImplementedError) est
+    signalée et ignorée ; contre un mongod, toute erreur interrompt le benchmark.
+    """
+    db = mongo_conn.db
+    # Opérations absentes de mongomock ; un tuple vide ne rattrape aucune exception
+    unsupported = (NotImplementedError,) if backend == 'mongomock' else ()
+
+    def measure(name, run, collections, count_after=False):
+        def count():
+            return sum(db[collection].estimated_document_count() for collection in collections)
+        documents = None if count_after else count()
+        start = time.perf_counter()
+        try:
+            run()
+        except unsupported as e:
+            print(f"⚠ {name} ignorée (non prise en charge par mongomock) : {e}")
+            return
+        elapsed = time.perf_counter() - start
+        samples.setdefault(name, []).append((elapsed, count() if count_after else documents))
+
+    measure('import', lambda: mongo_conn.import_data(dataset, streaming=True, batch_size=batch_size,
+                                                     workers=workers),
+            ('users', 'transactions'), count_after=True)
+
+    cleaner = DataCleaner(batch_size=batch_size, engine=engine, mongo_conn=mongo_conn)
+    measure('clean_users', cleaner.clean_users, ('users',))
+    measure('clean_transactions', cleaner.clean_transactions, ('transactions',))
+    measure('validate_relationships', cleaner.validate_relationships, ('transactions',))
+
+    aggregator = DataAggregator(index_policy='ignore', mongo_conn=mongo_conn)
+    queries = {name: (lambda collection=collection, pipeline=pipeline:
+                      list(db[collection].aggregate(pipeline, allowDiskUse=True)))
+               for name, (collection, pipeline) in aggregator.queries().items()}
+    queries['combined_report'] = aggregator.combined_report
+    for _ in range(query_repeat):
+        for name, run in queries.items():
+            collection = 'users' if name == 'users_without_transactions' else 'transactions'
+            measure(f'aggregations.{name}', run, (collection,))
+
+def benchmark_pipeline(documents=10_000, backend='mongod', uri=None, database=BENCHMARK_DATABASE,
+                       repeat=3, query_repeat=5, dataset=None, batch_size=DEFAULT_BATCH_SIZE,
+                       workers=1, engine='python', output=None, seed=42):
+    """Mesure débit et latences (p50/p95/p99) de chaque étape du pipeline.
+
+    Un jeu synthétique d'environ `documents` documents est généré (sauf si
+    `dataset` est fourni), puis importé, nettoyé et agrégé `repeat` fois dans
+    la base `database` ; chaque agrégation est exécutée `query_repeat` fois
+    par passage. Les percentiles portent sur l'ensemble des mesures d'une étape.
+    """
+    generated = dataset is None
+    if generated:
+        dataset = os.path.join(tempfile.gettempdir(), f'benchmark_{documents}_{seed}.json')
+        print(f"Génération d'environ {documents} documents dans {dataset}...")
+        counts = write_dataset(dataset, users_for_documents(documents), seed=seed)
+        print(f"✓ {counts['users']} utilisateurs, {counts['transactions']} transactions")
+
+    mongo_conn = benchmark_connection(backend, uri, database)
+    samples = {}
+    try:
+        for run in range(1, repeat + 1):
+            print(f"\n=== Passage {run}/{repeat} ({backend}) ===")
+            run_pipeline_once(mongo_conn, dataset, samples, batch_size=batch_size, workers=workers,
+                              engine=engine, query_repeat=query_repeat, backend=backend)
+    finally:
+        mongo_conn.close()
+        if generated:
+            os.remove(dataset)
+
+    report = {}
+    for name, measures in samples.items():
+        durations = [elapsed for elapsed, _ in measures]
+        median = percentile(durations, 50)
+        report[name] = {
+            'runs': len(durations),
+            'documents': measures[-1][1],
+            'docs_per_sec': measures[-1][1] / median if median else None,
+            'p50_s': median,
+            'p95_s': percentile(durations, 95),
+            'p99_s': percentile(durations, 99),
+            'max_s': max(durations),
+        }
+
+    print(f"\n=== Résultats ({backend}, {repeat} passage(s)) ===")
+    print(tabulate([
+        [name, r['runs'], r['documents'], f"{r['docs_per_sec']:,.0f}" if r['docs_per_sec'] else 'n/a',
+         f"{r['p50_s']:.4f}", f"{r['p95_s']:.4f}", f"{r['p99_s']:.4f}", f"{r['max_s']:.4f}"]
+        for name, r in report.items()
+    ], headers=['Étape', 'Mesures', 'Documents', 'Docs/s (p50)', 'p50 (s)', 'p95 (s)', 'p99 (s)', 'Max (s)'],
+        tablefmt='grid'))
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump({'backend': backend, 'documents': documents, 'repeat': repeat,
+                       'engine': engine, 'workers': workers, 'batch_size': batch_size,
+                       'stages': report}, f, indent=2, ensure_ascii=False)
+        print(f"✓ Résultats écrits dans {output}")
+    return report
+
+def benchmark_users_without_transactions(users=1_000_000, backend='mongod', uri=None,
+                                         database=BENCHMARK_DATABASE, repeat=3, seed=42):
+    """Compare les modes de users_without_transactions sur un jeu synthétique de `users` utilisateurs"""
+    dataset = os.path.join(tempfile.gettempdir(), f'benchmark_inactive_{users}_{seed}.json')
+    print(f"Génération de {users} utilisateurs et de leurs transactions...")
+    write_dataset(dataset, users, seed=seed)
+    mongo_conn = benchmark_connection(backend, uri, database)
+    try:
+        mongo_conn.import_data(dataset, streaming=True)
+        db = mongo_conn.db
+        UserStats(db).refresh(full=True)
+        rows = []
+        reference = None
+        full_time = None
+        for mode in ('full', 'lookup', 'stats'):
+            pipeline = DataAggregator.users_without_transactions_pipeline(mode)
+            durations = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = {doc['_id'] for doc in db.users.aggregate(pipeline, allowDiskUse=True)}
+                durations.append(time.perf_counter() - start)
+            median = percentile(durations, 50)
+            if reference is None:
+                reference, full_time = result, median
+            rows.append([mode, len(result), result == reference, f'{median:.3f}', f'x{full_time / median:.1f}'])
+        print(f"\nUtilisateurs: {db.users.estimated_document_count()}, "
+              f"transactions: {db.transactions.estimated_document_count()}")
+        print(tabulate(rows, headers=['Mode', 'Utilisateurs sans transaction', 'Identique à full',
+                                      'Temps médian (s)', 'Accélération'], tablefmt='grid'))
+        return rows
+    finally:
+        mongo_conn.close()
+        os.remove(dataset)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks du pipeline de nettoyage")
+    parser.add_argument('--users', type=int, default=1_000_000, help="Nombre d'utilisateurs synthétiques")
+    parser.add_argument('--aggregations', action='store_true',
+                        help="Compare les agrégations séparées et le rapport combiné (base requise)")
+    parser.add_argument('--inactive-users', type=int, metavar='N',
+                        help="Compare les modes de users_without_transactions sur N utilisateurs (base requise)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Mesure chaque étape du pipeline sur un jeu synthétique")
+    parser.add_argument('--documents', type=int, default=10_000,
+                        help="Taille approximative du jeu synthétique (10k à 50M documents)")
+    parser.add_argument('--backend', choices=['mongod', 'mongomock'], default='mongod',
+                        help="mongod local ou distant (--uri), ou mongomock en mémoire")
+    parser.add_argument('--uri', help="URI du mongod (MONGODB_URI par défaut)")
+    parser.add_argument('--database', default=BENCHMARK_DATABASE, help="Base utilisée (supprimée et rechargée)")
+    parser.add_argument('--dataset', help="Fichier JSON existant à utiliser au lieu d'un jeu généré")
+    parser.add_argument('--repeat', type=int, default=3, help="Nombre de passages complets")
+    parser.add_argument('--query-repeat', type=int, default=5, help="Exécutions de chaque agrégation par passage")
+    parser.add_argument('--engine', choices=['python', 'server'], default='python', help="Moteur de nettoyage")
+    parser.add_argument('--workers', type=int, default=1, help="Workers d'import")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--output', help="Fichier JSON des résultats")
+    args = parser.parse_args()
+    if args.inactive_users:
+        benchmark_users_without_transactions(users=args.inactive_users, backend=args.backend, uri=args.uri,
+                                             database=args.database, repeat=args.repeat)
+    elif args.pipeline:
+        benchmark_pipeline(documents=args.documents, backend=args.backend, uri=args.uri,
+                           database=args.database, repeat=args.repeat, query_repeat=args.query_repeat,
+                           dataset=args.dataset, batch_size=args.batch_size, workers=args.workers,
+                           engine=args.engine, output=args.output)
+    elif args.aggregations:
+        benchmark_aggregations()
+    else:
+        benchmark_user_cleaning(args.users)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import argparse
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from init_connection import MongoDBConnection, DEFAULT_BATCH_SIZE, STATE_COLLECTION, bump_load_generation, close_clients
+from data_cleaning import DataCleaner
+from user_stats import UserStats
+from metrics import StreamMetrics
+
+# Agrégats par statut (nombre, montant total et moyen) maintenus par le service
+STATUS_STATS_COLLECTION = 'status_stats'
+# Document de pipeline_state portant le jeton de reprise du change stream
+STREAM_STATE_ID = 'change_stream'
+# Jeton de reprise sorti de l'oplog : il faut repartir d'un rattrapage complet
+CHANGE_STREAM_HISTORY_LOST = 286
+# Attente maximale d'un getMore sans événement (borne aussi le délai d'arrêt)
+DEFAULT_MAX_AWAIT_MS = 1000
+
+def build_change_stream_pipeline(collections=('users', 'transactions')):
+    """Événements utiles au service.
+
+    Les mises à jour qui posent `cleaned_at` viennent d'un nettoyage (ce
+    service ou DataCleaner) : les traiter ferait boucler le service sur ses
+    propres écritures. `cleaned_at` change à chaque passage, contrairement à
+    `cleaning_version` qui n'apparaît pas dans l'événement s'il est inchangé.
+    """
+    return [{'$match': {
+        'ns.coll': {'$in': list(collections)},
+        'operationType': {'$in': ['insert', 'replace', 'update', 'delete']},
+        'updateDescription.updatedFields.cleaned_at': {'$exists': False},
+        # Seules les suppressions de transactions modifient les agrégats
+        '$nor': [{'ns.coll': 'users', 'operationType': 'delete'}],
+    }}]
+
+def event_time(change):
+    """Heure de l'écriture d'origine : wallTime (MongoDB 6.0+) ou clusterTime (précision à la seconde)"""
+    moment = change.get('wallTime') or change['clusterTime'].as_datetime()
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+class ChangeStreamService:
+    """Nettoyage et agrégation continus à partir des change streams.
+
+    Un seul change stream sur la base suit `users` et `transactions`. Les
+    événements sont traités par micro-lots (jusqu'à `batch_size`, sans
+    attendre au-delà de ce qui est disponible). Pour chaque lot :
+
+    1. les documents insérés, remplacés ou modifiés sont nettoyés avec les
+       règles de DataCleaner (une transaction au montant invalide est
+       supprimée). Chaque écriture est conditionnée aux valeurs lues, pour ne
+       jamais écraser une écriture plus récente, qui aura son propre événement ;
+    2. `user_stats` est recalculé pour les utilisateurs touchés, et
+       `status_stats` pour les statuts touchés, depuis transactions ;
+    3. le jeton de reprise est enregistré dans `pipeline_state`.
+
+    Le traitement est idempotent et le jeton est enregistré après le lot : un
+    redémarrage rejoue au plus le dernier lot. Les change streams exigent un
+    replica set (un nœud suffit). Avec les pré-images (MongoDB 6.0+), une
+    transaction supprimée est attribuée à son utilisateur ; sans elles, seul
+    `status_stats` est corrigé et `UserStats.refresh(full=True)` rattrape
+    `user_stats`.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, max_await_ms=DEFAULT_MAX_AWAIT_MS, pre_images=True,
+                 mongo_conn=None, metrics=None):
+        self.batch_size = batch_size
+        self.max_await_ms = max_await_ms
+        self.pre_images = pre_images
+        self.mongo_conn = mongo_conn or MongoDBConnection()
+        self.db = self.mongo_conn.connect()
+        self.metrics = metrics or StreamMetrics()
+        self.user_stats = UserStats(self.db, batch_size=batch_size)
+        self._stop = threading.Event()
+
+    def check_replica_set(self):
+        hello = self.db.client.admin.command('hello')
+        if not hello.get('setName') and hello.get('msg') != 'isdbgrid':
+            raise RuntimeError("Les change streams exigent un replica set "
+                               "(un nœud suffit : mongod --replSet rs0 puis rs.initiate())")
+
+    def enable_pre_images(self):
+        """Active les pré-images sur transactions (MongoDB 6.0+) ; retourne False si indisponible"""
+        if not self.pre_images:
+            return False
+        try:
+            self.db.command('collMod', 'transactions', changeStreamPreAndPostImages={'enabled': True})
+            return True
+        except OperationFailure as e:
+            print(f"⚠ Pré-images indisponibles ({e}) : les suppressions ne mettront à jour que status_stats")
+            self.pre_images = False
+            return False
+
+    def saved_resume_token(self):
+        state = self.db[STATE_COLLECTION].find_one({'_id': STREAM_STATE_ID})
+        return state.get('resume_token') if state else None
+
+    def save_resume_token(self, token):
+        self.db[STATE_COLLECTION].update_one({'_id': STREAM_STATE_ID}, {'$set': {
+            'resume_token': token, 'updated_at': datetime.now(timezone.utc)
+        }}, upsert=True)
+
+    def clear_resume_token(self):
+        self.db[STATE_COLLECTION].delete_one({'_id': STREAM_STATE_ID})
+
+    def open_stream(self, resume_token=None):
+        options = {'full_document': 'updateLookup', 'max_await_time_ms': self.max_await_ms}
+        if self.pre_images:
+            options['full_document_before_change'] = 'whenAvailable'
+        if resume_token is not None:
+            options['resume_after'] = resume_token
+        return self.db.watch(build_change_stream_pipeline(), **options)
+
+    def bootstrap(self):
+        """Rattrapage : nettoie les documents non marqués puis recalcule tous les agrégats.
+
+        Exécuté une fois le change stream ouvert : les écritures concurrentes
+        sont dans le flux et seront traitées ensuite.
+        """
+        print("Rattrapage initial...")
+        cleaner = DataCleaner(batch_size=self.batch_size, incremental=True, mongo_conn=self.mongo_conn)
+        cleaner.clean_users()
+        cleaner.clean_transactions()
+        self.user_stats.refresh(full=True)
+        self.refresh_statuses(None)
+
+    def stop(self):
+        """Demande l'arrêt après le micro-lot en cours (appelable depuis un autre thread)"""
+        self._stop.set()
+
+    def next_batch(self, stream):
+        """Événements disponibles, au plus batch_size (liste vide après max_await_ms sans événement)"""
+        batch = []
+        while len(batch) < self.batch_size:
+            change = stream.try_next()
+            if change is None:
+                break
+            batch.append(change)
+        return batch
+
+    @staticmethod
+    def needs_cleaning(change):
+        """Un document n'est nettoyé que s'il n'est pas marqué ou a changé depuis son nettoyage"""
+        document = change.get('fullDocument')
+        if document is None:
+            # Supprimé depuis (updateLookup) ou suppression
+            return False
+        return not DataCleaner.is_cleaned(change['ns']['coll'], document)
+
+    @staticmethod
+    def cleaning_operation(collection_name, document):
+        """Écriture de nettoyage d'un document, conditionnée aux valeurs lues.
+
+        Retourne (opération, champs corrigés).
+        """
+        if collection_name == 'transactions':
+            if DataCleaner.has_invalid_amount(document):
+                return DeleteOne({'_id': document['_id'], 'amount': document.get('amount')}), {}
+            fields = DataCleaner.transaction_update_fields(document)
+        else:
+            fields = DataCleaner.user_update_fields(document)
+        guard = {field: document.get(field) for field in fields}
+        stamp = DataCleaner.cleaning_stamp(collection_name, {**document, **fields})
+        operation = UpdateOne({'_id': document['_id'], **guard}, {'$set': {**fields, **stamp}})
+        return operation, fields
+
+    def write(self, collection_name, operations, counts):
+        if not operations:
+            return
+        try:
+            result = self.db[collection_name].bulk_write(operations, ordered=False)
+            counts['cleaned'] += result.modified_count
+            counts['deleted'] += result.deleted_count
+        except BulkWriteError as e:
+            counts['cleaned'] += e.details.get('nModified', 0)
+            counts['deleted'] += e.details.get('nRemoved', 0)
+            counts['write_errors'] += len(e.details.get('writeErrors', []))
+
+    def refresh_users(self, user_ids):
+        """Recalcule user_stats pour ces utilisateurs (supprime ceux qui n'ont plus de transaction)"""
+        user_ids = list(user_ids)
+        refresh_id = uuid.uuid4().hex
+        self.user_stats.merge({'user_id': {'$in': user_ids}}, refresh_id)
+        self.user_stats.collection.delete_many({'_id': {'$in': user_ids}, 'refresh_id': {'$ne': refresh_id}})
+
+    def refresh_statuses(self, statuses):
+        """Recalcule status_stats pour ces statuts (tous si None) via l'index (status, amount)"""
+        refresh_id = uuid.uuid4().hex
+        match = {} if statuses is None else {'status': {'$in': list(statuses)}}
+        self.db.transactions.aggregate([
+            {'$match': match},
+            {'$group': {
+                '_id': '$status',
+                'count': {'$sum': 1},
+                'total_amount': {'$sum': '$amount'},
+                'avg_amount': {'$avg': '$amount'}
+            }},
+            {'$set': {'refresh_id': refresh_id}},
+            {'$merge': {'into': STATUS_STATS_COLLECTION, 'on': '_id',
+                        'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ], allowDiskUse=True)
+        stale = {'refresh_id': {'$ne': refresh_id}}
+        if statuses is not None:
+            stale['_id'] = {'$in': list(statuses)}
+        self.db[STATUS_STATS_COLLECTION].delete_many(stale)
+
+    def process_batch(self, changes):
+        """Nettoie les documents du micro-lot puis met à jour les agrégats touchés"""
+        start = time.perf_counter()
+        counts = {'cleaned': 0, 'deleted': 0, 'write_errors': 0, 'users_refreshed': 0,
+                  'statuses_refreshed': 0, 'unattributed_deletes': 0}
+        # Dernière image de chaque document à nettoyer (un document modifié plusieurs fois n'est écrit qu'une fois)
+        to_clean = {'users': {}, 'transactions': {}}
+        user_ids = set()
+        statuses = set()
+        all_statuses = False
+
+        for change in changes:
+            collection_name = change['ns']['coll']
+            if self.needs_cleaning(change):
+                to_clean[collection_name][change['documentKey']['_id']] = change['fullDocument']
+            if collection_name != 'transactions':
+                continue
+            images = [image for image in (change.get('fullDocument'), change.get('fullDocumentBeforeChange')) if image]
+            for image in images:
+                user_ids.add(image.get('user_id'))
+                statuses.add(image.get('status'))
+            if change['operationType'] == 'delete' and not images:
+                counts['unattributed_deletes'] += 1
+                all_statuses = True
+
+        for collection_name, documents in to_clean.items():
+            operations = []
+            for document in documents.values():
+                operation, fields = self.cleaning_operation(collection_name, document)
+                operations.append(operation)
+                if 'status' in fields:
+                    # Le nettoyage remplace un statut invalide par PENDING
+                    statuses.add(fields['status'])
+            self.write(collection_name, operations, counts)
+
+        user_ids.discard(None)
+        if user_ids:
+            self.refresh_users(user_ids)
+            counts['users_refreshed'] = len(user_ids)
+        if statuses or all_statuses:
+            self.refresh_statuses(None if all_statuses else statuses)
+            counts['statuses_refreshed'] = len(statuses)
+        if counts['cleaned'] or counts['deleted'] or user_ids or statuses:
+            bump_load_generation(self.db)
+
+        done = datetime.now(timezone.utc)
+        lags = [(done - event_time(change)).total_seconds() for change in changes]
+        self.metrics.record_batch(lags, time.perf_counter() - start, **counts)
+        return counts
+
+    def consume(self, stream, deadline=None, max_events=None):
+        last_token = None
+        while not self._stop.is_set():
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if max_events is not None and self.metrics.counters['events'] >= max_events:
+                break
+            batch = self.next_batch(stream)
+            if batch:
+                self.process_batch(batch)
+            # Sans événement, le jeton avance quand même (postBatchResumeToken)
+            token = stream.resume_token
+            if token is not None and token != last_token:
+                self.save_resume_token(token)
+                last_token = token
+
+    def run(self, duration=None, max_events=None, bootstrap=False, prometheus_path=None):
+        """Exécute le service jusqu'à `duration` secondes, `max_events` événements, stop() ou Ctrl+C"""
+        self.check_replica_set()
+        self.user_stats.ensure_indexes()
+        self.enable_pre_images()
+        resume_token = None if bootstrap else self.saved_resume_token()
+        deadline = time.monotonic() + duration if duration else None
+        print(f"✓ Service démarré ({'reprise depuis le jeton enregistré' if resume_token else 'rattrapage initial'})")
+        try:
+            while True:
+                try:
+                    with self.open_stream(resume_token) as stream:
+                        if resume_token is None:
+                            self.bootstrap()
+                        self.consume(stream, deadline=deadline, max_events=max_events)
+                    break
+                except OperationFailure as e:
+                    if e.code != CHANGE_STREAM_HISTORY_LOST or resume_token is None:
+                        raise
+                    print("⚠ Jeton de reprise trop ancien pour l'oplog : rattrapage complet")
+                    self.clear_resume_token()
+                    resume_token = None
+        except KeyboardInterrupt:
+            print("\nArrêt demandé")
+        finally:
+            print("\nMétriques du service:")
+            self.metrics.print_summary()
+            if prometheus_path:
+                self.metrics.to_prometheus(prometheus_path)
+                print(f"✓ Métriques Prometheus écrites dans {prometheus_path}")
+        return self.metrics.report()
+
+def main():
+    parser = argparse.ArgumentParser(description="Service de nettoyage et d'agrégation continus (change streams)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="taille maximale d'un micro-lot")
+    parser.add_argument('--duration', type=float, default=None,
+                        help="durée d'exécution en secondes (illimitée par défaut)")
+    parser.add_argument('--max-events', type=int, default=None,
+                        help="arrêt après ce nombre d'événements")
+    parser.add_argument('--bootstrap', action='store_true',
+                        help="ignore le jeton enregistré et refait le rattrapage initial")
+    parser.add_argument('--prometheus', default=None,
+                        help="fichier de métriques au format texte Prometheus")
+    args = parser.parse_args()
+
+    service = ChangeStreamService(batch_size=args.batch_size)
+    try:
+        service.run(duration=args.duration, max_events=args.max_events, bootstrap=args.bootstrap,
+                    prometheus_path=args.prometheus)
+    finally:
+        service.mongo_conn.close()
+        close_clients()
+
+if __name__ == "__main__":
+    main()
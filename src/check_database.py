@@ -1,28 +1,194 @@
-from pymongo import MongoClient
-from pymongo.server_api import ServerApi
+import argparse
+import math
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from tabulate import tabulate
 from pprint import pprint
+from pymongo.errors import OperationFailure
+from init_connection import get_client, is_shared_client
+from data_cleaning import DataCleaner, VALID_STATUSES
 
 load_dotenv()
 
+# Taille de l'échantillon ($sample) utilisé pour estimer le taux de données sales
+DEFAULT_SAMPLE_SIZE = 1000
+# Nombre de collections sondées simultanément en mode rapide
+DEFAULT_PROBE_WORKERS = 8
+
+# Règles de données sales par collection : champ -> prédicat sur le document brut.
+# Elles reprennent les règles de DataCleaner : un champ est sale si le nettoyage le modifierait,
+# un montant s'il ferait supprimer la transaction, un timestamp s'il est absent ou illisible.
+DIRTY_RULES = {
+    'users': {
+        'email': lambda doc: DataCleaner.clean_email(doc) != doc.get('email'),
+        'phone': lambda doc: DataCleaner.clean_phone(doc.get('phone', '')) != doc.get('phone'),
+        'gender': lambda doc: DataCleaner.clean_gender(doc.get('gender', '')) != doc.get('gender'),
+        'first_name': lambda doc: not isinstance(doc.get('first_name'), str) or not doc.get('first_name'),
+        'last_name': lambda doc: not isinstance(doc.get('last_name'), str) or not doc.get('last_name'),
+    },
+    'transactions': {
+        'status': lambda doc: doc.get('status') not in VALID_STATUSES,
+        'amount': DataCleaner.has_invalid_amount,
+        'timestamp': lambda doc: DataCleaner.parse_timestamp(doc.get('timestamp')) is None,
+    },
+}
+
+def _format_mb(size):
+    return f"{size / 1024 / 1024:.2f} MB"
+
 class DatabaseChecker:
-    def __init__(self):
+    """Vérification de l'état des bases.
+
+    Le mode par défaut compte chaque collection exactement (count_documents,
+    parcours complet). Le mode rapide (`fast=True`) se contente du nombre
+    estimé (métadonnées), d'un seul $collStats par collection et d'un
+    échantillon $sample pour l'aperçu et le taux de données sales ; les
+    collections sont sondées en parallèle.
+    """
+
+    def __init__(self, client=None, fast=False, sample_size=DEFAULT_SAMPLE_SIZE, workers=DEFAULT_PROBE_WORKERS):
         self.uri = os.getenv('MONGODB_URI')
-        self.client = None
+        self.client = client
         self.db = None
+        self.fast = fast
+        self.sample_size = sample_size
+        self.workers = workers
 
     def connect(self):
         try:
-            self.client = MongoClient(self.uri, server_api=ServerApi('1'))
-            # Vérifier la connexion
-            self.client.admin.command('ping')
+            if self.client is None:
+                # Client partagé du processus (ping effectué à sa création)
+                self.client = get_client(self.uri)
             print("✓ Connexion à MongoDB établie avec succès!\n")
         except Exception as e:
             print(f"✗ Erreur de connexion: {e}")
             raise
 
+    def probe_all(self, probe, items):
+        """Applique `probe` à chaque élément en parallèle et retourne les résultats dans l'ordre"""
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(items)))) as executor:
+            return list(executor.map(probe, items))
+
+    @staticmethod
+    def collection_stats(db, coll):
+        """Statistiques de stockage via un unique $collStats (sommées sur les shards)"""
+        stats = {'count': 0, 'size': 0, 'storageSize': 0, 'totalIndexSize': 0, 'indexSizes': {}}
+        for shard in db[coll].aggregate([{'$collStats': {'storageStats': {}}}]):
+            storage = shard['storageStats']
+            for field in ('count', 'size', 'storageSize', 'totalIndexSize'):
+                stats[field] += storage.get(field, 0)
+            for name, size in storage.get('indexSizes', {}).items():
+                stats['indexSizes'][name] = stats['indexSizes'].get(name, 0) + size
+        stats['avgObjSize'] = stats['size'] / stats['count'] if stats['count'] else 0
+        return stats
+
+    def dirty_ratio(self, db, coll):
+        """Taux de valeurs sales par champ, estimé sur un échantillon $sample.
+
+        Retourne {champ: (proportion, marge d'erreur à 95 %)} et la taille de l'échantillon.
+        """
+        rules = DIRTY_RULES.get(coll)
+        if not rules:
+            return {}, 0
+        projection = {field: 1 for field in rules}
+        sample = list(db[coll].aggregate([{'$sample': {'size': self.sample_size}}, {'$project': projection}]))
+        n = len(sample)
+        ratios = {}
+        for field, is_dirty in rules.items():
+            p = sum(1 for doc in sample if is_dirty(doc)) / n if n else 0.0
+            ratios[field] = (p, 1.96 * math.sqrt(p * (1 - p) / n) if n else 0.0)
+        any_dirty = sum(1 for doc in sample if any(is_dirty(doc) for is_dirty in rules.values())) / n if n else 0.0
+        ratios['(document)'] = (any_dirty, 1.96 * math.sqrt(any_dirty * (1 - any_dirty) / n) if n else 0.0)
+        return ratios, n
+
+    def probe_collection(self, db, coll):
+        """Sonde rapide d'une collection : $collStats, aperçu $sample et taux de données sales"""
+        start = time.perf_counter()
+        probe = {'name': coll}
+        try:
+            probe['stats'] = self.collection_stats(db, coll)
+            probe['preview'] = list(db[coll].aggregate([{'$sample': {'size': 5}}]))
+            probe['dirty'], probe['sample_size'] = self.dirty_ratio(db, coll)
+        except OperationFailure as e:
+            # Vues et collections système : $collStats ou $sample indisponibles
+            probe['error'] = str(e)
+        probe['elapsed'] = time.perf_counter() - start
+        return probe
+
+    @staticmethod
+    def print_preview(coll, documents, label):
+        print(f"\n--- {coll.upper()} ({label}) ---")
+        headers = documents[0].keys() if documents else []
+        rows = [[str(doc.get(key, ''))[:50] + '...' if len(str(doc.get(key, ''))) > 50
+                else str(doc.get(key, '')) for key in headers]
+               for doc in documents]
+        print(tabulate(rows, headers=headers, tablefmt='grid'))
+
+    def check_database_fast(self):
+        """Vue d'ensemble : un dbStats par base et un nombre estimé par collection"""
+        print("=== BASES DE DONNÉES DISPONIBLES (mode rapide) ===")
+        for db_name in self.client.list_database_names():
+            if db_name in ['admin', 'local']:
+                continue
+            db = self.client[db_name]
+            stats = db.command('dbStats')
+            print(f"\nBase de données: {db_name} ({stats.get('collections', 0)} collections, "
+                  f"données {_format_mb(stats.get('dataSize', 0))}, index {_format_mb(stats.get('indexSize', 0))})")
+            collections = db.list_collection_names()
+            counts = self.probe_all(lambda coll: db[coll].estimated_document_count(), collections) if collections else []
+            for coll, count in zip(collections, counts):
+                print(f"  └── Collection: {coll} (~{count} documents)")
+
+    def check_test_database_fast(self):
+        """Détails de test_database à partir de sondes parallèles, sans parcours complet"""
+        print("\n=== DÉTAILS DE TEST_DATABASE (mode rapide) ===")
+        self.db = self.client.test_database
+
+        collections = self.db.list_collection_names()
+        if not collections:
+            print("La base test_database est vide!")
+            return
+
+        start = time.perf_counter()
+        probes = self.probe_all(lambda coll: self.probe_collection(self.db, coll), collections)
+        elapsed = time.perf_counter() - start
+
+        print("\n1. Collections présentes:")
+        for probe in probes:
+            if 'error' in probe:
+                print(f"   ✗ {probe['name']}: {probe['error']}")
+            else:
+                print(f"   ✓ {probe['name']}: ~{probe['stats']['count']} documents (sondée en {probe['elapsed']:.2f} s)")
+
+        print("\n2. Échantillon des données:")
+        for probe in probes:
+            if 'preview' in probe:
+                self.print_preview(probe['name'], probe['preview'], "5 documents aléatoires")
+
+        print("\n3. Statistiques des collections:")
+        rows = []
+        for probe in probes:
+            if 'stats' not in probe:
+                continue
+            stats = probe['stats']
+            rows.append([probe['name'], stats['count'], _format_mb(stats['size']),
+                         f"{stats['avgObjSize'] / 1024:.2f} KB", _format_mb(stats['totalIndexSize']),
+                         ', '.join(f"{name}={_format_mb(size)}" for name, size in stats['indexSizes'].items())])
+        print(tabulate(rows, headers=['Collection', 'Documents', 'Taille', 'Moy./doc', 'Index', 'Taille par index'],
+                       tablefmt='grid'))
+
+        print("\n4. Taux de données sales (échantillon):")
+        for probe in probes:
+            if not probe.get('dirty'):
+                continue
+            print(f"\n{probe['name']} ({probe['sample_size']} documents échantillonnés):")
+            print(tabulate([[field, f"{p:.1%}", f"±{margin:.1%}"] for field, (p, margin) in probe['dirty'].items()],
+                           headers=['Champ', 'Sales', 'Marge (95 %)'], tablefmt='grid'))
+
+        print(f"\n✓ {len(probes)} collections sondées en {elapsed:.2f} s ({self.workers} en parallèle)")
+
     def check_database(self):
         print("=== BASES DE DONNÉES DISPONIBLES ===")
         databases = self.client.list_database_names()
@@ -52,13 +218,7 @@ class DatabaseChecker:
 
         print("\n2. Échantillon des données:")
         for coll in collections:
-            print(f"\n--- {coll.upper()} (5 premiers documents) ---")
-            sample_data = list(self.db[coll].find().limit(5))
-            headers = sample_data[0].keys() if sample_data else []
-            rows = [[str(doc.get(key, ''))[:50] + '...' if len(str(doc.get(key, ''))) > 50 
-                    else str(doc.get(key, '')) for key in headers] 
-                   for doc in sample_data]
-            print(tabulate(rows, headers=headers, tablefmt='grid'))
+            self.print_preview(coll, list(self.db[coll].find().limit(5)), "5 premiers documents")
 
         print("\n3. Statistiques des collections:")
         for coll in collections:
@@ -72,17 +232,30 @@ class DatabaseChecker:
         try:
             self.connect()
             print("=== VÉRIFICATION DES BASES DE DONNÉES ===")
-            self.check_database()
-            self.check_test_database()
+            if self.fast:
+                self.check_database_fast()
+                self.check_test_database_fast()
+            else:
+                self.check_database()
+                self.check_test_database()
         except Exception as e:
             print(f"Une erreur s'est produite: {e}")
         finally:
-            if self.client:
+            if self.client and not is_shared_client(self.client):
                 self.client.close()
                 print("\n✓ Connexion fermée")
 
 def main():
-    checker = DatabaseChecker()
+    parser = argparse.ArgumentParser(description="Vérification de la base MongoDB")
+    parser.add_argument('--fast', action='store_true',
+                        help="nombres estimés, $collStats et échantillons $sample au lieu de parcours complets")
+    parser.add_argument('--sample-size', type=int, default=DEFAULT_SAMPLE_SIZE,
+                        help="taille de l'échantillon pour le taux de données sales (mode rapide)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_PROBE_WORKERS,
+                        help="collections sondées simultanément (mode rapide)")
+    args = parser.parse_args()
+
+    checker = DatabaseChecker(fast=args.fast, sample_size=args.sample_size, workers=args.workers)
     checker.run_checks()
 
 if __name__ == "__main__":
@@ -0,0 +1,74 @@
+import os
+from datetime import datetime, timezone
+from init_connection import STATE_COLLECTION
+
+# Préfixe des documents de reprise dans pipeline_state : « checkpoint:<étape> »
+CHECKPOINT_PREFIX = 'checkpoint:'
+PIPELINE_STAGES = ('import', 'clean_users', 'clean_transactions', 'validate_relationships', 'aggregations')
+
+def source_fingerprint(path):
+    """Empreinte du fichier source (taille, date de modification) : une reprise suppose un fichier inchangé"""
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+class StageCheckpoints:
+    """Points de reprise des étapes du pipeline, stockés dans `pipeline_state`.
+
+    Chaque étape a un document `checkpoint:<étape>` avec son statut
+    ('running' puis 'done') et sa progression : `last_id` (dernier `_id`
+    traité par les étapes qui parcourent une collection triée par `_id`) ou
+    `positions` (documents lus dans le fichier par collection, pour l'import).
+    Une étape interrompue reprend après son dernier point enregistré ; une
+    étape terminée est sautée. Les écritures de chaque lot étant idempotentes,
+    retraiter un lot enregistré trop tôt est sans effet.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db[STATE_COLLECTION]
+
+    @staticmethod
+    def key(stage):
+        return f'{CHECKPOINT_PREFIX}{stage}'
+
+    def get(self, stage):
+        return self.collection.find_one({'_id': self.key(stage)})
+
+    def is_done(self, stage):
+        checkpoint = self.get(stage)
+        return bool(checkpoint) and checkpoint.get('status') == 'done'
+
+    def resume_point(self, stage, field='last_id'):
+        """Progression d'une étape interrompue (None si l'étape n'a pas commencé ou est terminée)"""
+        checkpoint = self.get(stage)
+        if not checkpoint or checkpoint.get('status') != 'running':
+            return None
+        return checkpoint.get(field)
+
+    def save(self, stage, **progress):
+        """Enregistre la progression d'une étape en cours"""
+        self.collection.update_one({'_id': self.key(stage)}, {'$set': {
+            **progress, 'status': 'running', 'updated_at': datetime.now(timezone.utc)
+        }}, upsert=True)
+
+    def complete(self, stage, **summary):
+        self.collection.update_one({'_id': self.key(stage)}, {'$set': {
+            **summary, 'status': 'done', 'updated_at': datetime.now(timezone.utc)
+        }}, upsert=True)
+
+    def reset(self, stages=None):
+        """Efface les points de reprise (toutes les étapes par défaut) : la prochaine exécution repart de zéro"""
+        if stages is None:
+            return self.collection.delete_many({'_id': {'$regex': f'^{CHECKPOINT_PREFIX}'}}).deleted_count
+        return self.collection.delete_many({'_id': {'$in': [self.key(stage) for stage in stages]}}).deleted_count
+
+    def source_matches(self, fingerprint):
+        """Vrai si l'import enregistré porte sur le même fichier source"""
+        checkpoint = self.get('import')
+        return bool(checkpoint) and checkpoint.get('source') == fingerprint
+
+    def summary(self):
+        """Statut de chaque étape du pipeline : 'done', 'running' ou None"""
+        states = {doc['_id'][len(CHECKPOINT_PREFIX):]: doc.get('status')
+                  for doc in self.collection.find({'_id': {'$regex': f'^{CHECKPOINT_PREFIX}'}})}
+        return {stage: states.get(stage) for stage in PIPELINE_STAGES}
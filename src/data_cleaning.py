@@ -1,31 +1,399 @@
+import importlib.util
 import re
-from datetime import datetime
-from init_connection import MongoDBConnection
+import time
+from datetime import datetime, timezone
+import pandas as pd
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from init_connection import MongoDBConnection, DEFAULT_BATCH_SIZE, bump_load_generation
+
+EMAIL_PATTERN = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+EMAIL_RE = re.compile(EMAIL_PATTERN)
+PHONE_STRIP_RE = re.compile(r'[^\d+]+')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+VALID_STATUSES = ['SUCCESS', 'PENDING', 'FAILED']
+# Version des règles de nettoyage : à incrémenter à chaque modification des règles
+# pour que les documents nettoyés par une version antérieure soient retraités
+# (2 : timestamps convertis en dates BSON au lieu de chaînes ISO)
+CLEANING_VERSION = 2
+# Champs dont les valeurs nettoyées sont recopiées dans `cleaned_values` : un document
+# dont l'un de ces champs a changé depuis son nettoyage est retraité (voir cleaning_filter)
+TRACKED_FIELDS = {
+    'users': ('email', 'phone', 'gender', 'first_name', 'last_name'),
+    'transactions': ('amount', 'timestamp', 'status'),
+}
+
+def _type_is(field, bson_type):
+    return {'$eq': [{'$type': field}, bson_type]}
+
+def _last_chars(expr, n):
+    """Équivalent serveur de expr[-n:]"""
+    return {'$substrCP': [expr, {'$max': [0, {'$subtract': [{'$strLenCP': expr}, n]}]}, n]}
+
+def _name_token(field):
+    """Équivalent serveur de str(user.get(field, '')).lower()"""
+    return {'$switch': {
+        'branches': [
+            {'case': _type_is(field, 'missing'), 'then': ''},
+            {'case': _type_is(field, 'null'), 'then': 'none'},
+            {'case': _type_is(field, 'bool'), 'then': {'$cond': [field, 'true', 'false']}},
+        ],
+        'default': {'$toLower': {'$toString': field}}
+    }}
+
+def build_user_cleaning_pipeline():
+    """Pipeline de mise à jour reproduisant clean_email, clean_phone, clean_gender
+    et les valeurs par défaut de first_name/last_name côté serveur"""
+    fallback_email = {'$concat': [_name_token('$first_name'), '.', _name_token('$last_name'), '@example.com']}
+    email = {'$cond': [
+        _type_is('$email', 'string'),
+        {'$cond': [{'$regexMatch': {'input': '$email', 'regex': EMAIL_PATTERN}}, '$email', fallback_email]},
+        fallback_email
+    ]}
+
+    # re.sub(r'[^\d+]', '', phone)
+    digits = {'$reduce': {
+        'input': {'$regexFindAll': {'input': '$phone', 'regex': r'[\d+]'}},
+        'initialValue': '',
+        'in': {'$concat': ['$$value', '$$this.match']}
+    }}
+    prefixed = {'$switch': {
+        'branches': [
+            {'case': {'$eq': [{'$substrCP': ['$$digits', 0, 4]}, '+213']}, 'then': '$$digits'},
+            {'case': {'$eq': [{'$substrCP': ['$$digits', 0, 1]}, '+']},
+             'then': {'$concat': ['+213', _last_chars(
+                 {'$substrCP': ['$$digits', 1, {'$strLenCP': '$$digits'}]}, 9)]}},
+        ],
+        'default': {'$concat': ['+213', _last_chars('$$digits', 9)]}
+    }}
+    local_part = {'$substrCP': ['$$prefixed', 4, {'$strLenCP': '$$prefixed'}]}
+    padded = {'$switch': {
+        'branches': [
+            {'case': {'$gt': [{'$strLenCP': '$$prefixed'}, 13]},
+             'then': {'$substrCP': ['$$prefixed', 0, 13]}},
+            {'case': {'$lt': [{'$strLenCP': '$$prefixed'}, 13]},
+             'then': {'$concat': ['+213', {'$substrCP': ['000000000', 0, {'$subtract': [9, {'$strLenCP': local_part}]}]},
+                                  local_part]}},
+        ],
+        'default': '$$prefixed'
+    }}
+    phone = {'$cond': [
+        _type_is('$phone', 'string'),
+        {'$let': {'vars': {'digits': digits},
+                  'in': {'$let': {'vars': {'prefixed': prefixed}, 'in': padded}}}},
+        '+213000000000'
+    ]}
+
+    gender = {'$switch': {
+        'branches': [
+            {'case': {'$ne': [{'$type': '$gender'}, 'string']}, 'then': 'Unknown'},
+            {'case': {'$in': [{'$toUpper': '$gender'}, ['MALE', 'M']]}, 'then': 'Male'},
+            {'case': {'$in': [{'$toUpper': '$gender'}, ['FEMALE', 'F']]}, 'then': 'Female'},
+        ],
+        'default': 'Unknown'
+    }}
+
+    def name_default(field, default):
+        return {'$cond': [
+            {'$and': [_type_is(field, 'string'), {'$ne': [field, '']}]},
+            field,
+            default
+        ]}
+
+    # Un seul $set : toutes les expressions voient les valeurs d'origine,
+    # comme clean_email qui utilise les noms avant remplacement
+    return [{'$set': {
+        'email': email,
+        'phone': phone,
+        'gender': gender,
+        'first_name': name_default('$first_name', 'Unknown'),
+        'last_name': name_default('$last_name', 'User'),
+    }}]
+
+def build_transaction_cleaning_pipeline():
+    """Pipeline de mise à jour reproduisant côté serveur clean_transactions : conversion
+    du timestamp en date BSON et liste blanche des statuts"""
+    parts = {'$split': ['$timestamp', '.']}
+    # Date à la seconde + millisecondes tronquées de la partie fractionnaire (1 à 6 chiffres),
+    # comme l'encodage BSON d'un datetime Python
+    seconds = {'$dateFromString': {
+        'dateString': {'$arrayElemAt': [parts, 0]},
+        'format': '%Y-%m-%dT%H:%M:%S',
+        'timezone': 'UTC',
+        'onError': None
+    }}
+    milliseconds = {'$floor': {'$divide': [
+        {'$toInt': {'$substrCP': [{'$concat': [{'$arrayElemAt': [parts, 1]}, '000000']}, 0, 6]}},
+        1000
+    ]}}
+    valid_timestamp = {'$cond': [
+        _type_is('$timestamp', 'string'),
+        {'$and': [
+            {'$regexMatch': {'input': '$timestamp',
+                             'regex': r'^\d{4}-\d{1,2}-\d{1,2}T\d{1,2}:\d{1,2}:\d{1,2}\.\d{1,6}$'}},
+            {'$ne': [seconds, None]}
+        ]},
+        False
+    ]}
+    return [{'$set': {
+        'timestamp': {'$switch': {
+            'branches': [
+                {'case': _type_is('$timestamp', 'missing'), 'then': '$$REMOVE'},
+                {'case': _type_is('$timestamp', 'date'), 'then': '$timestamp'},
+                {'case': valid_timestamp, 'then': {'$add': [seconds, milliseconds]}},
+            ],
+            'default': '$$NOW'
+        }},
+        'status': {'$cond': [{'$in': ['$status', VALID_STATUSES]}, '$status', 'PENDING']}
+    }}]
+
+# Les opérations .str sont exécutées par les noyaux Arrow si pyarrow est installé,
+# sinon pandas retombe sur une boucle Python (mêmes résultats, moins rapide)
+STRING_DTYPE = pd.StringDtype('pyarrow' if importlib.util.find_spec('pyarrow') else 'python')
+
+def _text_column(frame, field):
+    """Retourne (chaînes typées, masque des valeurs textuelles) pour une colonne.
+
+    Les valeurs non textuelles deviennent NA ; une colonne absente est
+    entièrement NA, ce qui équivaut à user.get(field, '') pour les règles.
+    """
+    if field not in frame:
+        return (pd.Series(pd.NA, index=frame.index, dtype=STRING_DTYPE),
+                pd.Series(False, index=frame.index))
+    column = frame[field]
+    if isinstance(column.dtype, pd.StringDtype):
+        return column.astype(STRING_DTYPE), column.notna()
+    is_str = column.map(type) == str
+    return column.where(is_str, None).astype(STRING_DTYPE), is_str
+
+def _name_tokens(frame, field):
+    """Équivalent vectorisé de str(user.get(field, '')).lower() (une valeur nulle donne '')"""
+    if field not in frame:
+        return pd.Series('', index=frame.index, dtype=STRING_DTYPE)
+    column = frame[field]
+    if not isinstance(column.dtype, pd.StringDtype):
+        column = column.map(str).where(column.notna(), None)
+    return column.astype(STRING_DTYPE).fillna('').str.lower()
+
+def clean_user_records(records):
+    """Nettoie un lot d'utilisateurs en mémoire, colonne par colonne.
+
+    Applique les mêmes règles que clean_email, clean_phone, clean_gender et
+    les valeurs par défaut des noms, mais avec des opérations vectorisées
+    pandas et des regex précompilées. `records` est une liste de dicts ou un
+    DataFrame ; retourne un DataFrame des colonnes nettoyées (plus `_id`).
+    Seule différence : un nom nul (None/NaN) compte comme absent dans l'email
+    de repli, là où clean_email écrirait "none".
+    """
+    frame = records if isinstance(records, pd.DataFrame) else pd.DataFrame.from_records(records)
+
+    # Email : conservé s'il est valide, sinon prenom.nom@example.com
+    emails, _ = _text_column(frame, 'email')
+    email_valid = emails.str.match(EMAIL_PATTERN).fillna(False).astype(bool)
+    fallback_email = _name_tokens(frame, 'first_name') + '.' + _name_tokens(frame, 'last_name') + '@example.com'
+    clean_email = emails.where(email_valid, fallback_email)
+
+    # Téléphone : +213 suivi des 9 derniers chiffres (ou des 9 premiers après +213), complété par des 0
+    phones, _ = _text_column(frame, 'phone')
+    digits = phones.str.replace(PHONE_STRIP_RE.pattern, '', regex=True)
+    local_part = digits.str.removeprefix('+').str[-9:].where(~digits.str.startswith('+213'), digits.str[4:13])
+    clean_phone = ('+213' + local_part.str.pad(9, side='left', fillchar='0')).fillna('+213000000000')
+
+    # Genre : Male / Female / Unknown
+    genders, _ = _text_column(frame, 'gender')
+    gender_upper = genders.str.upper()
+    clean_gender = pd.Series('Unknown', index=frame.index, dtype=STRING_DTYPE)
+    clean_gender[gender_upper.isin(['MALE', 'M']).fillna(False).astype(bool)] = 'Male'
+    clean_gender[gender_upper.isin(['FEMALE', 'F']).fillna(False).astype(bool)] = 'Female'
+
+    first_names, _ = _text_column(frame, 'first_name')
+    last_names, _ = _text_column(frame, 'last_name')
+    cleaned = pd.DataFrame({
+        'email': clean_email,
+        'phone': clean_phone,
+        'gender': clean_gender,
+        'first_name': first_names.where(first_names.fillna('') != '', 'Unknown'),
+        'last_name': last_names.where(last_names.fillna('') != '', 'User'),
+    }, index=frame.index)
+    if '_id' in frame:
+        cleaned.insert(0, '_id', frame['_id'])
+    return cleaned
+
+# Transactions au montant négatif, nul ou absent (supprimées par le nettoyage)
+INVALID_AMOUNT_FILTER = {
+    '$or': [
+        {'amount': {'$lte': 0}},
+        {'amount': {'$exists': False}},
+        {'amount': None}
+    ]
+}
+
+# Anti-jointure : transactions dont le user_id n'existe pas dans users.
+# Le $lookup s'appuie sur l'index _id de users et ne ramène au plus qu'un _id.
+def build_orphan_transactions_pipeline(users_collection='users'):
+    """Anti-jointure : _id des transactions dont le user_id n'existe pas dans `users_collection`"""
+    return [
+        {'$project': {'user_id': 1}},
+        {'$lookup': {
+            'from': users_collection,
+            'localField': 'user_id',
+            'foreignField': '_id',
+            'pipeline': [{'$project': {'_id': 1}}, {'$limit': 1}],
+            'as': 'user'
+        }},
+        {'$match': {'user': {'$size': 0}}},
+        {'$project': {'_id': 1}}
+    ]
+
+ORPHAN_TRANSACTIONS_PIPELINE = build_orphan_transactions_pipeline()
+
+def tracked_values_expression(kind):
+    """Valeurs courantes des champs suivis (un champ absent est omis, comme dans cleaning_stamp)"""
+    return {field: f'${field}' for field in TRACKED_FIELDS[kind]}
+
+def record_bulk_write(stats, collection_name, operation_count, result=None, error=None):
+    """Met à jour les compteurs d'un lot d'écritures : `result` du bulk_write ou BulkWriteError levée"""
+    stats['batches'] += 1
+    if error is None:
+        stats['modified'] += result.modified_count
+        return
+    write_errors = error.details.get('writeErrors', [])
+    stats['modified'] += error.details.get('nModified', 0)
+    stats['errors'] += len(write_errors)
+    print(f"Lot {stats['batches']} ({collection_name}): {len(write_errors)} erreurs "
+          f"sur {operation_count} mises à jour")
+
+def server_cleaning_stamp(kind):
+    """Équivalent serveur de DataCleaner.cleaning_stamp(), à placer après le pipeline de nettoyage"""
+    return [{'$set': {
+        'cleaning_version': {'$literal': CLEANING_VERSION},
+        'cleaned_at': '$$NOW',
+        # $mergeObjects remplace le sous-document au lieu de fusionner avec l'ancien
+        'cleaned_values': {'$mergeObjects': [tracked_values_expression(kind)]},
+    }}]
+
+def server_cleaning_update(kind):
+    """Pipeline de mise à jour complet du moteur serveur : règles de nettoyage puis marquage"""
+    rules = build_user_cleaning_pipeline() if kind == 'users' else build_transaction_cleaning_pipeline()
+    return rules + server_cleaning_stamp(kind)
 
 class DataCleaner:
-    def __init__(self):
-        self.mongo_conn = MongoDBConnection()
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, engine='python', incremental=False, mongo_conn=None,
+                 checkpoints=None, collection_names=None):
+        self.batch_size = batch_size
+        # 'python' : nettoyage document par document côté client
+        # 'server' : pipelines de mise à jour exécutés par MongoDB (repli sur 'python' en cas d'échec)
+        self.engine = engine
+        # Ne traiter que les documents nouveaux, modifiés ou nettoyés par une version antérieure
+        self.incremental = incremental
+        # Une connexion existante peut être injectée pour partager son client
+        self.mongo_conn = mongo_conn or MongoDBConnection()
         self.db = self.mongo_conn.connect()
+        # Points de reprise par lot (StageCheckpoints) pour le moteur Python, None pour les désactiver
+        self.checkpoints = checkpoints
+        # Collections nettoyées : les collections en service ou leurs collections fantômes
+        # (voir staging_collection_names)
+        collection_names = collection_names or {}
+        self.users = self.db[collection_names.get('users', 'users')]
+        self.transactions = self.db[collection_names.get('transactions', 'transactions')]
+
+    def flush_updates(self, collection, operations, stats):
+        """Envoie un lot d'UpdateOne via un bulk_write non ordonné et met à jour les compteurs"""
+        if not operations:
+            return
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            record_bulk_write(stats, collection.name, len(operations), error=e)
+        else:
+            record_bulk_write(stats, collection.name, len(operations), result=result)
+        operations.clear()
+
+    def cleaning_filter(self, kind):
+        """Filtre des documents à nettoyer (`kind` : 'users' ou 'transactions').
+
+        Un document est retraité s'il n'a jamais été nettoyé, s'il l'a été par
+        une version antérieure des règles, ou si ses champs suivis ne sont plus
+        égaux aux valeurs recopiées dans `cleaned_values` lors du nettoyage :
+        une modification est détectée sans coopération des autres rédacteurs.
+        La comparaison ($expr) parcourt la collection côté serveur ; seuls les
+        documents à retraiter sont transférés et réécrits.
+        """
+        if not self.incremental:
+            return {}
+        return {'$or': [
+            {'cleaning_version': {'$ne': CLEANING_VERSION}},
+            {'$expr': {'$ne': ['$cleaned_values', tracked_values_expression(kind)]}},
+        ]}
+
+    def documents_to_clean(self, collection, stage, kind):
+        """Curseur des documents à nettoyer.
+
+        Avec des points de reprise, le parcours est trié par `_id` et reprend
+        après le dernier `_id` enregistré par une exécution interrompue.
+        """
+        query = self.cleaning_filter(kind)
+        if self.checkpoints is None:
+            return collection.find(query)
+        last_id = self.checkpoints.resume_point(stage)
+        if last_id is not None:
+            print(f"Reprise de {stage} après l'_id {last_id!r}")
+            query = {**query, '_id': {'$gt': last_id}}
+        return collection.find(query, batch_size=self.batch_size).sort('_id', 1)
+
+    def save_checkpoint(self, stage, last_id, stats):
+        """Enregistre le dernier _id d'un lot écrit"""
+        if self.checkpoints is not None:
+            self.checkpoints.save(stage, last_id=last_id, batches=stats['batches'])
+
+    @staticmethod
+    def cleaning_stamp(kind, document):
+        """Champs de marquage posés sur un document nettoyé (`document` : valeurs après nettoyage)"""
+        return {
+            'cleaning_version': CLEANING_VERSION,
+            'cleaned_at': datetime.now(timezone.utc),
+            'cleaned_values': {field: document[field] for field in TRACKED_FIELDS[kind] if field in document},
+        }
 
-    def clean_email(self, user):
+    @classmethod
+    def cleaning_update(cls, kind, document):
+        """UpdateOne de nettoyage d'un document : champs corrigés et marquage.
+
+        Le marquage est posé même sans correction pour exclure le document des prochains passages.
+        """
+        rule = cls.user_update_fields if kind == 'users' else cls.transaction_update_fields
+        fields = rule(document)
+        fields.update(cls.cleaning_stamp(kind, {**document, **fields}))
+        return UpdateOne({'_id': document['_id']}, {'$set': fields})
+
+    @staticmethod
+    def is_cleaned(kind, document):
+        """Vrai si le document est marqué par la version courante et inchangé depuis (cf. cleaning_filter)"""
+        return (document.get('cleaning_version') == CLEANING_VERSION and
+                document.get('cleaned_values') ==
+                {field: document[field] for field in TRACKED_FIELDS[kind] if field in document})
+
+    @staticmethod
+    def clean_email(user):
         """Nettoie l'email d'un utilisateur"""
         try:
             email = user.get('email', '')
             if not isinstance(email, str):
                 return f"{str(user.get('first_name', '')).lower()}.{str(user.get('last_name', '')).lower()}@example.com"
-            if not re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', email):
+            if not EMAIL_RE.match(email):
                 return f"{str(user.get('first_name', '')).lower()}.{str(user.get('last_name', '')).lower()}@example.com"
             return email
         except Exception as e:
             print(f"Erreur lors du nettoyage de l'email pour l'utilisateur {user.get('_id')}: {e}")
             return f"user.{user.get('_id')}@example.com"
 
-    def clean_phone(self, phone):
+    @staticmethod
+    def clean_phone(phone):
         """Nettoie un numéro de téléphone"""
         try:
             if not isinstance(phone, str):
                 return '+213000000000'
-            cleaned = re.sub(r'[^\d+]', '', phone)
+            cleaned = PHONE_STRIP_RE.sub('', phone)
             # Si le numéro ne commence pas par +213
             if not cleaned.startswith('+213'):
                 if cleaned.startswith('+'):
@@ -41,7 +409,8 @@ class DataCleaner:
             print(f"Erreur lors du nettoyage du numéro de téléphone {phone}: {e}")
             return '+213000000000'
 
-    def clean_gender(self, gender):
+    @staticmethod
+    def clean_gender(gender):
         try:
             if not isinstance(gender, str):
                 return 'Unknown'
@@ -55,88 +424,228 @@ class DataCleaner:
             print(f"Erreur lors du nettoyage du genre {gender}: {e}")
             return 'Unknown'
 
+    @classmethod
+    def user_update_fields(cls, user):
+        """Calcule les champs nettoyés d'un utilisateur"""
+        update_fields = {
+            'email': cls.clean_email(user),
+            'phone': cls.clean_phone(user.get('phone', '')),
+            'gender': cls.clean_gender(user.get('gender', ''))
+        }
+        
+        if not isinstance(user.get('first_name'), str) or not user.get('first_name'):
+            update_fields['first_name'] = 'Unknown'
+        if not isinstance(user.get('last_name'), str) or not user.get('last_name'):
+            update_fields['last_name'] = 'User'
+        return update_fields
+
+    @staticmethod
+    def parse_timestamp(value):
+        """Convertit un timestamp texte (TIMESTAMP_FORMAT, UTC) en datetime, None s'il est invalide.
+
+        Les microsecondes sont tronquées à la milliseconde, précision d'une date BSON.
+        """
+        if isinstance(value, datetime):
+            return value
+        try:
+            parsed = datetime.strptime(str(value), TIMESTAMP_FORMAT)
+        except ValueError:
+            return None
+        return parsed.replace(microsecond=parsed.microsecond // 1000 * 1000)
+
+    @staticmethod
+    def transaction_update_fields(tx):
+        """Calcule les champs à corriger d'une transaction (dict vide si rien à faire)"""
+        update_fields = {}
+        
+        # Le timestamp est stocké en date BSON ; une valeur illisible est remplacée par l'heure courante
+        if 'timestamp' in tx and not isinstance(tx['timestamp'], datetime):
+            update_fields['timestamp'] = DataCleaner.parse_timestamp(tx['timestamp']) or datetime.now(timezone.utc)
+
+        if 'status' not in tx or not isinstance(tx['status'], str) or \
+           tx['status'] not in VALID_STATUSES:
+            update_fields['status'] = 'PENDING'
+        return update_fields
+
+    @staticmethod
+    def has_invalid_amount(tx):
+        """Même critère que delete_invalid_amounts : montant absent, nul ou numérique <= 0"""
+        amount = tx.get('amount')
+        if amount is None:
+            return True
+        return isinstance(amount, (int, float)) and not isinstance(amount, bool) and amount <= 0
+
+    @classmethod
+    def clean_for_ingest(cls, collection_name, document):
+        """Transformation de l'import fusionné (import_data(transform=...)).
+
+        Applique les règles de nettoyage avant l'insertion et retourne
+        (document nettoyé, None) ou (None, raison du rejet).
+        """
+        if collection_name == 'users':
+            cleaned = {**document, **cls.user_update_fields(document)}
+        elif cls.has_invalid_amount(document):
+            return None, 'invalid_amount'
+        else:
+            cleaned = {**document, **cls.transaction_update_fields(document)}
+        return {**cleaned, **cls.cleaning_stamp(collection_name, cleaned)}, None
+
     def clean_users(self):
+        """Nettoie les données utilisateurs avec le moteur configuré"""
+        try:
+            if self.engine == 'server':
+                try:
+                    return self.clean_users_server_side()
+                except OperationFailure as e:
+                    print(f"Nettoyage côté serveur impossible ({e}), repli sur le moteur Python")
+            return self.clean_users_python()
+        finally:
+            bump_load_generation(self.db)
+
+    def clean_transactions(self):
+        """Nettoie les données transactions avec le moteur configuré"""
+        try:
+            if self.engine == 'server':
+                try:
+                    return self.clean_transactions_server_side()
+                except OperationFailure as e:
+                    print(f"Nettoyage côté serveur impossible ({e}), repli sur le moteur Python")
+            return self.clean_transactions_python()
+        finally:
+            bump_load_generation(self.db)
+
+    def clean_users_python(self):
         """Nettoie les données utilisateurs"""
         print("Début du nettoyage des utilisateurs...")
         count = 0
+        operations = []
+        stats = {'batches': 0, 'modified': 0, 'errors': 0}
         
-        for user in self.db.users.find():
-            try:
-                update_fields = {
-                    'email': self.clean_email(user),
-                    'phone': self.clean_phone(user.get('phone', '')),
-                    'gender': self.clean_gender(user.get('gender', ''))
-                }
-                
-                if not isinstance(user.get('first_name'), str) or not user.get('first_name'):
-                    update_fields['first_name'] = 'Unknown'
-                if not isinstance(user.get('last_name'), str) or not user.get('last_name'):
-                    update_fields['last_name'] = 'User'
-
-                self.db.users.update_one(
-                    {'_id': user['_id']},
-                    {'$set': update_fields}
-                )
-                count += 1
-                if count % 100 == 0:
-                    print(f"Traitement de {count} utilisateurs...")
-                
-            except Exception as e:
-                print(f"Erreur lors du nettoyage de l'utilisateur {user.get('_id')}: {e}")
-                continue
-
-        print(f"✓ Nettoyage terminé pour {count} utilisateurs")
+        for user in self.documents_to_clean(self.users, 'clean_users', 'users'):
+            operations.append(self.cleaning_update('users', user))
+            count += 1
+            if len(operations) >= self.batch_size:
+                self.flush_updates(self.users, operations, stats)
+                self.save_checkpoint('clean_users', user['_id'], stats)
+                print(f"Traitement de {count} utilisateurs...")
 
-    def clean_transactions(self):
+        self.flush_updates(self.users, operations, stats)
+        print(f"✓ Nettoyage terminé pour {count} utilisateurs "
+              f"({stats['modified']} modifiés, {stats['errors']} erreurs en {stats['batches']} lots)")
+        return stats
+
+    def delete_invalid_amounts(self):
+        """Supprime les transactions au montant négatif, nul ou absent.
+
+        Pas de filtre incrémental : une transaction nettoyée et inchangée a
+        forcément un montant valide.
+        """
+        return self.transactions.delete_many(INVALID_AMOUNT_FILTER).deleted_count
+
+    def clean_transactions_python(self):
         """Nettoie les données transactions"""
         print("\nDébut du nettoyage des transactions...")
         count = 0
         
-        self.db.transactions.delete_many({
-            '$or': [
-                {'amount': {'$lte': 0}},
-                {'amount': {'$exists': False}},
-                {'amount': None}
-            ]
-        })
-
-        for tx in self.db.transactions.find():
-            try:
-                update_fields = {}
-                
-                if 'timestamp' in tx:
-                    try:
-                        datetime.strptime(str(tx['timestamp']), '%Y-%m-%dT%H:%M:%S.%f')
-                    except:
-                        update_fields['timestamp'] = datetime.now().isoformat()
-
-                if 'status' not in tx or not isinstance(tx['status'], str) or \
-                   tx['status'] not in ['SUCCESS', 'PENDING', 'FAILED']:
-                    update_fields['status'] = 'PENDING'
-
-                if update_fields:
-                    self.db.transactions.update_one(
-                        {'_id': tx['_id']},
-                        {'$set': update_fields}
-                    )
-                count += 1
-                
-                if count % 100 == 0:
-                    print(f"Traitement de {count} transactions...")
-                    
-            except Exception as e:
-                print(f"Erreur lors du nettoyage de la transaction {tx.get('_id')}: {e}")
-                continue
-
-        print(f"✓ Nettoyage terminé pour {count} transactions")
+        self.delete_invalid_amounts()
+
+        operations = []
+        stats = {'batches': 0, 'modified': 0, 'errors': 0}
+
+        for tx in self.documents_to_clean(self.transactions, 'clean_transactions', 'transactions'):
+            operations.append(self.cleaning_update('transactions', tx))
+            count += 1
+            
+            if len(operations) >= self.batch_size:
+                self.flush_updates(self.transactions, operations, stats)
+                self.save_checkpoint('clean_transactions', tx['_id'], stats)
+                print(f"Traitement de {count} transactions...")
+
+        self.flush_updates(self.transactions, operations, stats)
+        print(f"✓ Nettoyage terminé pour {count} transactions "
+              f"({stats['modified']} modifiées, {stats['errors']} erreurs en {stats['batches']} lots)")
+        return stats
+
+    def clean_users_server_side(self):
+        """Nettoie les utilisateurs via un update_many à pipeline (aucun document ne transite par le client)"""
+        print("Début du nettoyage des utilisateurs (côté serveur)...")
+        result = self.users.update_many(self.cleaning_filter('users'), server_cleaning_update('users'))
+        stats = {'batches': 1, 'modified': result.modified_count, 'errors': 0}
+        print(f"✓ Nettoyage terminé pour {result.matched_count} utilisateurs ({result.modified_count} modifiés)")
+        return stats
+
+    def clean_transactions_server_side(self):
+        """Nettoie les transactions via un update_many à pipeline"""
+        print("\nDébut du nettoyage des transactions (côté serveur)...")
+        self.delete_invalid_amounts()
+        result = self.transactions.update_many(self.cleaning_filter('transactions'),
+                                               server_cleaning_update('transactions'))
+        stats = {'batches': 1, 'modified': result.modified_count, 'errors': 0}
+        print(f"✓ Nettoyage terminé pour {result.matched_count} transactions ({result.modified_count} modifiées)")
+        return stats
+
+    def check_engine_parity(self, sample_size=None):
+        """Vérifie que les moteurs Python et serveur produisent des résultats identiques.
+
+        Les pipelines serveur sont évalués en lecture seule via aggregate() sur les
+        données actuelles, puis comparés aux fonctions Python document par document.
+        Un timestamp invalide est remplacé par l'heure courante : on vérifie alors
+        seulement que les deux moteurs le remplacent par une date.
+        """
+        print("\nVérification de la parité des moteurs de nettoyage...")
+        mismatches = []
+        checks = [
+            (self.users, build_user_cleaning_pipeline(), self.user_update_fields),
+            (self.transactions, build_transaction_cleaning_pipeline(), self.transaction_update_fields),
+        ]
+        for collection, pipeline, python_rule in checks:
+            stages = [{'$sample': {'size': sample_size}}] if sample_size else []
+            stages += [{'$set': {'_raw': '$$ROOT'}}] + pipeline
+            for doc in collection.aggregate(stages):
+                raw = doc.pop('_raw')
+                expected = {**raw, **python_rule(raw)}
+                for field in set(expected) | set(doc):
+                    if field == 'timestamp' and field in raw and self.parse_timestamp(raw[field]) is None:
+                        same = isinstance(doc.get(field), datetime)
+                    else:
+                        same = expected.get(field) == doc.get(field)
+                    if not same:
+                        mismatches.append((collection.name, raw['_id'], field, expected.get(field), doc.get(field)))
+
+        for name, _id, field, python_value, server_value in mismatches[:10]:
+            print(f"  ✗ {name} {_id}.{field}: python={python_value!r} serveur={server_value!r}")
+        if mismatches:
+            print(f"✗ {len(mismatches)} différences entre les moteurs Python et serveur")
+        else:
+            print("✓ Les moteurs Python et serveur produisent des résultats identiques")
+        return not mismatches
+
+    def find_orphan_transaction_ids(self):
+        """Anti-jointure côté serveur : _id des transactions dont le user_id n'existe pas,
+        lus par curseur"""
+        return self.transactions.aggregate(build_orphan_transactions_pipeline(self.users.name),
+                                           allowDiskUse=True, batchSize=self.batch_size)
 
     def validate_relationships(self):
         print("\nValidation des relations...")
-        valid_users = set(u['_id'] for u in self.db.users.find({}, {'_id': 1}))
-        deleted = self.db.transactions.delete_many({
-            'user_id': {'$nin': list(valid_users)}
-        }).deleted_count
-        print(f"✓ {deleted} transactions avec user_id invalide supprimées")
+        start = time.perf_counter()
+        found = 0
+        deleted = 0
+        orphan_ids = []
+        # Suppression par lots bornés de $in plutôt qu'un $nin géant sur tous les utilisateurs
+        for orphan in self.find_orphan_transaction_ids():
+            orphan_ids.append(orphan['_id'])
+            found += 1
+            if len(orphan_ids) >= self.batch_size:
+                deleted += self.transactions.delete_many({'_id': {'$in': orphan_ids}}).deleted_count
+                orphan_ids = []
+        if orphan_ids:
+            deleted += self.transactions.delete_many({'_id': {'$in': orphan_ids}}).deleted_count
+        if deleted:
+            bump_load_generation(self.db)
+        elapsed = time.perf_counter() - start
+        print(f"✓ {found} transactions orphelines trouvées, {deleted} supprimées en {elapsed:.2f} s")
+        return {'found': found, 'deleted': deleted, 'elapsed': elapsed}
 
     def clean_all(self):
         try:
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda',
+               'Glenn', 'Rebekah', 'Karen', 'Thomas', 'Nancy', 'Daniel', 'Lisa', 'Mark']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis',
+              'Rivers', 'Watts', 'Costa', 'Moore', 'Taylor', 'Thomas', 'Jackson', 'White']
+EMAIL_DOMAINS = ['example.org', 'example.net', 'example.com']
+GENDERS = ['None', 'Other', 'Unknown', 'Male', 'Female', 123]
+INVALID_EMAILS = ['invalidemail.com', 'invalid@domain', 'invalid@.com']
+INVALID_TIMESTAMPS = ['invalid_date', '2024-13-45T25:61:00', '24/10/2024 15:41']
+STATUSES = ['SUCCESS', 123, 'None', 'PENDING', 'Invalid', 'FAILED']
+STATUS_WEIGHTS = [21, 17, 16, 16, 15, 15]
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Proportions de défauts mesurées sur users_transactions_with_issues.json
+DIRTY_PROFILE = {
+    'numeric_first_name': 0.06,
+    'numeric_last_name': 0.05,
+    'invalid_email': 0.09,
+    'duplicate_email': 0.01,
+    'max_transactions_per_user': 6,
+    'orphan_transaction': 0.05,
+    'missing_amount': 0.014,
+    'negative_amount': 0.13,
+    'missing_timestamp': 0.016,
+    'invalid_timestamp': 0.005,
+    'missing_status': 0.015,
+}
+
+def random_phone(rng):
+    """Numéro de téléphone dans l'un des formats rencontrés dans le dump source"""
+    area, mid, end = rng.randint(200, 999), rng.randint(100, 999), rng.randint(1000, 9999)
+    return rng.choice([
+        f'{area}-{mid}-{end}',
+        f'({area}){mid}-{end}',
+        f'{area}.{mid}.{end}',
+        f'{area}{mid}{end}',
+        f'+1-{area}-{mid}-{end}x{rng.randint(10, 99999)}',
+        f'001-{area}-{mid}-{end}',
+        '+12345678901234567890',
+        '+213123',
+        'abcd-efgh-ijkl',
+        '',
+    ])
+
+def generate_user(rng, index, previous_email=None, profile=DIRTY_PROFILE):
+    """Un utilisateur synthétique d'identifiant u<index>"""
+    first_name = rng.choice(FIRST_NAMES)
+    last_name = rng.choice(LAST_NAMES)
+    draw = rng.random()
+    if draw < profile['invalid_email']:
+        email = rng.choice(INVALID_EMAILS + [f'{first_name.lower()}@{last_name.lower()}'])
+    elif previous_email and draw < profile['invalid_email'] + profile['duplicate_email']:
+        # Doublon : rejeté par l'index unique sur email à l'import
+        email = previous_email
+    else:
+        email = f'{first_name.lower()}.{last_name.lower()}{index}@{rng.choice(EMAIL_DOMAINS)}'
+    if rng.random() < profile['numeric_first_name']:
+        first_name = rng.randint(1000, 9999)
+    if rng.random() < profile['numeric_last_name']:
+        last_name = rng.randint(1000, 9999)
+    return {
+        '_id': f'u{index}',
+        'first_name': first_name,
+        'last_name': last_name,
+        'email': email,
+        'gender': rng.choice(GENDERS),
+        'phone': random_phone(rng),
+    }
+
+def generate_transaction(rng, index, user_id, now, profile=DIRTY_PROFILE):
+    """Une transaction synthétique d'identifiant t<index>"""
+    tx = {'_id': f't{index}', 'user_id': user_id}
+    draw = rng.random()
+    if draw >= profile['missing_amount']:
+        if draw < profile['missing_amount'] + profile['negative_amount']:
+            tx['amount'] = round(rng.uniform(-100, 0), 2)
+        else:
+            tx['amount'] = round(rng.uniform(1, 1000), 2)
+    draw = rng.random()
+    if draw >= profile['missing_timestamp']:
+        if draw < profile['missing_timestamp'] + profile['invalid_timestamp']:
+            tx['timestamp'] = rng.choice(INVALID_TIMESTAMPS)
+        else:
+            tx['timestamp'] = (now - timedelta(seconds=rng.randint(0, 90 * 24 * 3600),
+                                               microseconds=rng.randint(0, 999999))).strftime(TIMESTAMP_FORMAT)
+    if rng.random() >= profile['missing_status']:
+        tx['status'] = rng.choices(STATUSES, STATUS_WEIGHTS)[0]
+    return tx
+
+def iter_dataset(user_count, seed=42, profile=DIRTY_PROFILE):
+    """Produit des tuples (collection, document) : chaque utilisateur suivi de ses transactions.
+
+    Les transactions orphelines référencent des user_id au-delà de `user_count`.
+    Le jeu est entièrement déterminé par `seed`.
+    """
+    rng = random.Random(seed)
+    now = datetime(2025, 1, 1)
+    tx_index = 0
+    previous_email = None
+    for index in range(1, user_count + 1):
+        user = generate_user(rng, index, previous_email, profile)
+        previous_email = user['email']
+        transactions = []
+        for _ in range(rng.randint(0, profile['max_transactions_per_user'])):
+            tx_index += 1
+            transactions.append(generate_transaction(rng, tx_index, user['_id'], now, profile))
+        user['transactions'] = [tx['_id'] for tx in transactions]
+        yield 'users', user
+        for tx in transactions:
+            yield 'transactions', tx
+            if rng.random() < profile['orphan_transaction']:
+                tx_index += 1
+                orphan_id = f'u{user_count + rng.randint(1, 1000)}'
+                yield 'transactions', generate_transaction(rng, tx_index, orphan_id, now, profile)
+
+def generate_users(count, seed=42):
+    """Liste d'utilisateurs synthétiques (sans leurs transactions)"""
+    return [doc for name, doc in iter_dataset(count, seed) if name == 'users']
+
+def users_for_documents(documents, profile=DIRTY_PROFILE):
+    """Nombre d'utilisateurs donnant environ `documents` documents au total"""
+    transactions_per_user = profile['max_transactions_per_user'] / 2 * (1 + profile['orphan_transaction'])
+    return max(1, round(documents / (1 + transactions_per_user)))
+
+def write_dataset(path, user_count, seed=42, profile=DIRTY_PROFILE):
+    """Écrit un dump au format du fichier source ({"users": [...], "transactions": [...]}).
+
+    La mémoire reste constante : les transactions sont écrites dans un fichier
+    temporaire puis recopiées après le tableau des utilisateurs.
+    """
+    counts = {'users': 0, 'transactions': 0}
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, 'w', encoding='utf-8') as out, \
+            tempfile.TemporaryFile('w+', encoding='utf-8', dir=directory) as tx_file:
+        out.write('{"users": [\n')
+        for name, doc in iter_dataset(user_count, seed, profile):
+            target = out if name == 'users' else tx_file
+            if counts[name]:
+                target.write(',\n')
+            target.write(json.dumps(doc))
+            counts[name] += 1
+        out.write('\n],\n"transactions": [\n')
+        tx_file.seek(0)
+        shutil.copyfileobj(tx_file, out)
+        out.write('\n]}\n')
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Génère un jeu de données synthétique avec les défauts du dump source")
+    parser.add_argument('path', help="fichier JSON à écrire")
+    parser.add_argument('--documents', type=int, default=10_000,
+                        help="nombre approximatif de documents (utilisateurs + transactions)")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    counts = write_dataset(args.path, users_for_documents(args.documents), seed=args.seed)
+    print(f"✓ {counts['users']} utilisateurs et {counts['transactions']} transactions écrits dans {args.path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+from pymongo import ASCENDING, IndexModel
+
+# Index requis par le pipeline, par collection.
+# (user_id, amount) et (status, amount) couvrent aussi les requêtes sur user_id
+# et status seuls (préfixe) et permettent des parcours d'index couverts pour
+# les $group de DataAggregator.
+REQUIRED_INDEXES = {
+    'users': [
+        IndexModel([('email', ASCENDING)], name='email_1', unique=True),
+    ],
+    'transactions': [
+        IndexModel([('user_id', ASCENDING), ('amount', ASCENDING)], name='user_id_1_amount_1'),
+        IndexModel([('status', ASCENDING), ('amount', ASCENDING)], name='status_1_amount_1'),
+        IndexModel([('timestamp', ASCENDING)], name='timestamp_1'),
+    ],
+}
+
+# Étapes d'un plan d'exécution qui indiquent l'utilisation d'un index
+INDEX_STAGES = {'IXSCAN', 'DISTINCT_SCAN', 'COUNT_SCAN', 'IDHACK', 'EXPRESS_IXSCAN', 'EXPRESS_CLUSTERED_IXSCAN'}
+
+def _plan_stages(node):
+    """Liste les noms d'étapes (stage) d'un document explain, récursivement"""
+    stages = []
+    if isinstance(node, dict):
+        if isinstance(node.get('stage'), str):
+            stages.append(node['stage'])
+        for value in node.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(node, list):
+        for value in node:
+            stages.extend(_plan_stages(value))
+    return stages
+
+class IndexManager:
+    def __init__(self, db):
+        self.db = db
+
+    def build_indexes(self, collections=None, collection_names=None):
+        """Crée les index requis (à appeler après le chargement en masse).
+
+        `collection_names` permet de les construire sur d'autres collections
+        (collections fantômes) : ils sont conservés par le renommage.
+        """
+        for name, models in REQUIRED_INDEXES.items():
+            if collections and name not in collections:
+                continue
+            target = (collection_names or {}).get(name, name)
+            created = self.db[target].create_indexes(models)
+            print(f"✓ Index {target}: {', '.join(created)}")
+
+    def has_index(self, collection_name, fields):
+        """Vrai si un index de la collection commence par les champs donnés"""
+        if fields == ['_id']:
+            return True
+        for info in self.db[collection_name].index_information().values():
+            keys = [field for field, _ in info['key']]
+            if keys[:len(fields)] == fields:
+                return True
+        return False
+
+    def missing_indexes(self):
+        """Retourne la liste des (collection, nom d'index) requis absents"""
+        missing = []
+        for name, models in REQUIRED_INDEXES.items():
+            existing = self.db[name].index_information()
+            for model in models:
+                if model.document['name'] not in existing:
+                    missing.append((name, model.document['name']))
+        return missing
+
+    def check_indexes(self, policy='warn'):
+        """Vérifie la présence des index requis.
+
+        policy : 'fail' lève une RuntimeError, 'warn' affiche un avertissement,
+        'ignore' ne fait rien.
+        """
+        if policy == 'ignore':
+            return []
+        missing = self.missing_indexes()
+        if missing:
+            details = ', '.join(f"{name}.{index}" for name, index in missing)
+            if policy == 'fail':
+                raise RuntimeError(f"Index requis manquants: {details}")
+            print(f"⚠ Index requis manquants: {details}")
+        return missing
+
+    def explain_pipeline(self, collection_name, pipeline):
+        """Analyse l'utilisation des index par un pipeline d'agrégation.
+
+        Le plan de la collection source est obtenu par explain (queryPlanner,
+        sans exécuter la requête) ; pour chaque $lookup, on vérifie qu'un index
+        existe sur le foreignField de la collection jointe.
+        """
+        explain = self.db.command('explain', {
+            'aggregate': collection_name,
+            'pipeline': pipeline,
+            'cursor': {}
+        }, verbosity='queryPlanner')
+        stages = _plan_stages(explain)
+        lookups = []
+        for stage in pipeline:
+            lookup = stage.get('$lookup')
+            if lookup and 'foreignField' in lookup:
+                lookups.append((lookup['from'], lookup['foreignField'],
+                                self.has_index(lookup['from'], [lookup['foreignField']])))
+        return {
+            'uses_index': bool(INDEX_STAGES.intersection(stages)),
+            'collscan': 'COLLSCAN' in stages,
+            'stages': stages,
+            'lookups': lookups,
+        }
+
+    def explain_aggregations(self, aggregator):
+        """Vérifie avec explain() que chaque requête de DataAggregator utilise un index"""
+        print("\n=== Utilisation des index par les agrégations ===")
+        report = {}
+        for name, (collection_name, pipeline) in aggregator.queries().items():
+            result = self.explain_pipeline(collection_name, pipeline)
+            report[name] = result
+            scan = 'index' if result['uses_index'] else 'COLLSCAN'
+            print(f"{'✓' if result['uses_index'] else '⚠'} {name}: {collection_name} via {scan}")
+            for target, field, indexed in result['lookups']:
+                print(f"    {'✓' if indexed else '⚠'} $lookup {target}.{field}: "
+                      f"{'indexé' if indexed else 'sans index'}")
+        return report
@@ -1,42 +1,400 @@
+import atexit
 import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from dotenv import load_dotenv
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 from pymongo.server_api import ServerApi
 import json
+from datetime import datetime, timezone
+import ijson
+from indexes import IndexManager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 # Charger les variables d'environnement
 load_dotenv()
 
+# Taille par défaut des lots pour l'import en streaming
+DEFAULT_BATCH_SIZE = 1000
+# Code d'erreur MongoDB pour une violation d'index unique
+DUPLICATE_KEY_ERROR = 11000
+# Collection recevant les documents rejetés par l'import fusionné, avec la raison du rejet
+QUARANTINE_COLLECTION = 'quarantine'
+# Vue matérialisée dérivée de transactions (voir user_stats.py), supprimée à chaque réimport
+USER_STATS_COLLECTION = 'user_stats'
+# Collection de contrôle : un document par traitement (filigranes, compteurs)
+STATE_COLLECTION = 'pipeline_state'
+LOAD_GENERATION_ID = 'load_generation'
+# Suffixe des collections fantômes chargées puis basculées par renommage (chargement sans interruption)
+STAGING_SUFFIX = '_staging'
+
+# Registre des MongoClient partagés par le processus, indexés par (URI, options)
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client_options():
+    """Options du pool de connexions lues depuis l'environnement.
+
+    Seules les variables définies sont transmises ; sinon les valeurs par
+    défaut de PyMongo s'appliquent. MONGODB_COMPRESSORS accepte par exemple
+    "zstd,snappy,zlib" (zstd et snappy nécessitent les paquets zstandard et
+    python-snappy).
+    """
+    options = {}
+    int_settings = {
+        'maxPoolSize': 'MONGODB_MAX_POOL_SIZE',
+        'minPoolSize': 'MONGODB_MIN_POOL_SIZE',
+        'maxIdleTimeMS': 'MONGODB_MAX_IDLE_TIME_MS',
+        'connectTimeoutMS': 'MONGODB_CONNECT_TIMEOUT_MS',
+        'serverSelectionTimeoutMS': 'MONGODB_SERVER_SELECTION_TIMEOUT_MS',
+        'socketTimeoutMS': 'MONGODB_SOCKET_TIMEOUT_MS',
+    }
+    for option, variable in int_settings.items():
+        if os.getenv(variable):
+            options[option] = int(os.getenv(variable))
+    if os.getenv('MONGODB_COMPRESSORS'):
+        options['compressors'] = os.getenv('MONGODB_COMPRESSORS')
+    return options
+
+def get_client(uri=None, **overrides):
+    """Retourne le MongoClient partagé du processus pour cette URI.
+
+    Le client (et donc son pool de connexions) est créé et testé par un ping
+    au premier appel, puis réutilisé par toutes les étapes du pipeline.
+    """
+    uri = uri or os.getenv('MONGODB_URI')
+    options = {**client_options(), **overrides}
+    key = (uri, tuple(sorted(options.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = MongoClient(uri, server_api=ServerApi('1'), **options)
+            # Tester la connexion une seule fois par client
+            client.admin.command('ping')
+            _clients[key] = client
+        return client
+
+def is_shared_client(client):
+    return any(shared is client for shared in _clients.values())
+
+def close_clients():
+    """Ferme tous les clients partagés"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+atexit.register(close_clients)
+
+def load_generation(db):
+    """Compteur de génération des données (0 si aucun chargement n'a été enregistré)"""
+    state = db[STATE_COLLECTION].find_one({'_id': LOAD_GENERATION_ID})
+    return state.get('generation', 0) if state else 0
+
+def bump_load_generation(db):
+    """Signale une modification des données : à appeler après chaque import ou nettoyage.
+
+    Les caches de résultats (QueryCache) invalident leurs entrées quand le compteur change.
+    Avec une base du client asynchrone, retourne la coroutine à attendre.
+    """
+    return db[STATE_COLLECTION].update_one({'_id': LOAD_GENERATION_ID}, {'$inc': {'generation': 1}}, upsert=True)
+
+def staging_collection_names(collections=('users', 'transactions', QUARANTINE_COLLECTION)):
+    """Correspondance collection en service -> collection fantôme ({'users': 'users_staging', ...})"""
+    return {name: f'{name}{STAGING_SUFFIX}' for name in collections}
+
+def get_peak_rss_mb():
+    """Retourne le pic de mémoire résidente du processus en Mo (None si indisponible)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sur macOS, en kilo-octets sur Linux
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+def iter_json_collections(file_obj, collections=('users', 'transactions')):
+    """Parcourt le dump JSON de façon incrémentale.
+
+    Produit des tuples (collection, document) pour chaque élément des tableaux
+    de premier niveau listés dans `collections`, sans charger le fichier en mémoire.
+    """
+    item_prefixes = {f'{name}.item': name for name in collections}
+    current = None
+    builder = None
+    for prefix, event, value in ijson.parse(file_obj, use_float=True):
+        if builder is None:
+            if prefix not in item_prefixes:
+                continue
+            if event in ('start_map', 'start_array'):
+                current = prefix
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            else:
+                yield item_prefixes[prefix], value
+            continue
+
+        builder.event(event, value)
+        if prefix == current and event in ('end_map', 'end_array'):
+            yield item_prefixes[current], builder.value
+            current = None
+            builder = None
+
 class MongoDBConnection:
-    def __init__(self):
+    def __init__(self, client=None):
         self.uri = os.getenv('MONGODB_URI')
-        self.client = None
+        self.client = client
         self.db = None
 
     def connect(self):
-        """Établit la connexion à MongoDB"""
+        """Établit la connexion à MongoDB (via le client partagé du processus)"""
+        if self.db is not None:
+            return self.db
         try:
-            self.client = MongoClient(self.uri, server_api=ServerApi('1'))
+            if self.client is None:
+                self.client = get_client(self.uri)
             self.db = self.client[os.getenv('DATABASE_NAME')]
-            # Tester la connexion
-            self.client.admin.command('ping')
             print("Connexion à MongoDB établie avec succès!")
             return self.db
         except Exception as e:
             print(f"Erreur de connexion: {e}")
             raise
 
-    def drop_collections(self):
-        """Supprime les collections existantes"""
+    def drop_collections(self, collection_names=None):
+        """Supprime les collections existantes.
+
+        Avec `collection_names` (voir staging_collection_names), seules les
+        collections cibles sont supprimées : les collections en service et
+        user_stats restent intactes.
+        """
         try:
-            self.db.users.drop()
-            self.db.transactions.drop()
+            names = collection_names or {}
+            self.db[names.get('users', 'users')].drop()
+            self.db[names.get('transactions', 'transactions')].drop()
+            if not collection_names:
+                self.db[USER_STATS_COLLECTION].drop()
             print("Collections existantes supprimées avec succès")
         except Exception as e:
             print(f"Erreur lors de la suppression des collections: {e}")
 
-    def import_data(self, file_path):
-        """Importe les données depuis le fichier JSON"""
+    def quarantine(self, collection_name, rejected, target=QUARANTINE_COLLECTION):
+        """Écrit des documents rejetés [(document, raison), ...] dans la collection de quarantaine `target`"""
+        if not rejected:
+            return
+        now = datetime.now(timezone.utc)
+        self.db[target].insert_many([
+            {'source': collection_name, 'reason': reason, 'document': document, 'quarantined_at': now}
+            for document, reason in rejected
+        ], ordered=False)
+
+    def insert_batch(self, collection_name, documents, quarantine_failures=False, target=None,
+                     quarantine_target=QUARANTINE_COLLECTION):
+        """Insère un lot de documents dans `target` (par défaut `collection_name`).
+
+        Retourne (insérés, doublons, autres erreurs) : les violations de
+        l'index unique (code 11000) sont comptées sans interrompre le lot.
+        Avec `quarantine_failures`, les documents refusés sont mis en
+        quarantaine dans `quarantine_target`.
+        """
+        try:
+            result = self.db[target or collection_name].insert_many(documents, ordered=False)
+            return len(result.inserted_ids), 0, 0
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            duplicates = sum(1 for err in write_errors if err.get('code') == DUPLICATE_KEY_ERROR)
+            if quarantine_failures:
+                self.quarantine(collection_name, [
+                    (err['op'], 'duplicate_key' if err.get('code') == DUPLICATE_KEY_ERROR else err.get('errmsg'))
+                    for err in write_errors
+                ], quarantine_target)
+            return e.details.get('nInserted', 0), duplicates, len(write_errors) - duplicates
+
+    def stream_import_data(self, file_path, batch_size=DEFAULT_BATCH_SIZE, workers=1, transform=None,
+                           checkpoints=None, collection_names=None):
+        """Importe le fichier JSON en streaming, par lots de taille fixe.
+
+        La mémoire consommée reste bornée par `batch_size` (× `workers`)
+        quelle que soit la taille du fichier. Avec `workers > 1`, les lots
+        sont insérés en parallèle par un pool de threads qui partagent le
+        pool de connexions du même MongoClient.
+
+        `transform(collection, document)` est appliqué à chaque document avant
+        insertion et retourne (document, None) ou (None, raison) : les documents
+        rejetés, ainsi que ceux refusés à l'insertion, vont en quarantaine.
+
+        Avec `checkpoints` (StageCheckpoints), le nombre de documents lus et
+        écrits par collection est enregistré après chaque lot. Un import
+        interrompu reprend alors sans supprimer les collections : les documents
+        déjà écrits sont sautés dans le fichier, et un lot rejoué n'est compté
+        qu'en doublons de _id.
+
+        `collection_names` redirige le chargement vers d'autres collections
+        (collections fantômes), sans toucher aux collections en service. La
+        quarantaine y est redirigée aussi : ses rejets remplacent ceux du
+        chargement précédent à la bascule (swap_collections).
+        """
+        quarantine_target = (collection_names or {}).get(QUARANTINE_COLLECTION, QUARANTINE_COLLECTION)
+        try:
+            if not os.path.exists(file_path):
+                raise FileNotFoundError(f"Le fichier {file_path} n'existe pas")
+
+            resume_positions = checkpoints.resume_point('import', 'positions') if checkpoints else None
+            if resume_positions:
+                print(f"Reprise de l'import après {resume_positions.get('users', 0)} utilisateurs et "
+                      f"{resume_positions.get('transactions', 0)} transactions")
+            else:
+                self.drop_collections(collection_names)
+                if transform is not None:
+                    self.db[quarantine_target].drop()
+                    if quarantine_target != QUARANTINE_COLLECTION:
+                        # Créée même sans rejet : la bascule remplace alors la quarantaine en service
+                        self.db.create_collection(quarantine_target)
+            # L'index unique sur email doit exister pendant le chargement pour écarter les doublons
+            IndexManager(self.db).build_indexes(['users'], collection_names)
+
+            start = time.perf_counter()
+            batches = {'users': [], 'transactions': []}
+            stats = {name: {'inserted': 0, 'duplicates': 0, 'errors': 0, 'batches': 0, 'rejected': 0}
+                     for name in batches}
+            rejected = {name: [] for name in batches}
+            targets = {name: (collection_names or {}).get(name, name) for name in batches}
+            quarantine_failures = transform is not None
+            executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+            pending = {}
+            # Documents lus dans le fichier, et documents lus puis confiés à l'écriture, par collection
+            read = {name: 0 for name in batches}
+            skip = {name: (resume_positions or {}).get(name, 0) for name in batches}
+            submitted_positions = dict(skip)
+            # Lots soumis au pool avec les positions qu'ils valident, dans l'ordre de soumission
+            submitted = deque()
+
+            def save_checkpoint():
+                # Seules les positions dont tous les lots précédents sont écrits sont enregistrées
+                positions = None
+                while submitted and submitted[0][0].done() and submitted[0][0].exception() is None:
+                    positions = submitted.popleft()[1]
+                if positions is not None:
+                    checkpoints.save('import', positions=positions)
+
+            def record(name, result):
+                n_ok, n_dup, n_err = result
+                stats[name]['inserted'] += n_ok
+                stats[name]['duplicates'] += n_dup
+                stats[name]['errors'] += n_err
+                stats[name]['batches'] += 1
+
+            def drain(return_when):
+                done, _ = wait(pending, return_when=return_when)
+                for future in done:
+                    record(pending.pop(future), future.result())
+
+            def flush(name):
+                if not batches[name]:
+                    return
+                documents, batches[name] = batches[name], []
+                if checkpoints is not None:
+                    # Les rejets en attente sont écrits avec le lot : tout ce qui a été lu est alors traité
+                    flush_rejected(name)
+                    submitted_positions[name] = read[name]
+                if executor is None:
+                    record(name, self.insert_batch(name, documents, quarantine_failures, targets[name],
+                                                         quarantine_target))
+                    if checkpoints is not None:
+                        checkpoints.save('import', positions=dict(submitted_positions))
+                    return
+                # Limiter le nombre de lots en vol pour borner la mémoire
+                if len(pending) >= workers * 2:
+                    drain(FIRST_COMPLETED)
+                future = executor.submit(self.insert_batch, name, documents, quarantine_failures, targets[name],
+                                         quarantine_target)
+                pending[future] = name
+                if checkpoints is not None:
+                    submitted.append((future, dict(submitted_positions)))
+                    save_checkpoint()
+
+            def flush_rejected(name):
+                stats[name]['rejected'] += len(rejected[name])
+                self.quarantine(name, rejected[name], quarantine_target)
+                rejected[name] = []
+
+            try:
+                with open(file_path, 'rb') as file:
+                    for name, document in iter_json_collections(file, tuple(batches)):
+                        read[name] += 1
+                        if read[name] <= skip[name]:
+                            continue
+                        if transform is not None:
+                            cleaned, reason = transform(name, document)
+                            if cleaned is None:
+                                rejected[name].append((document, reason))
+                                if len(rejected[name]) >= batch_size:
+                                    flush_rejected(name)
+                                continue
+                            document = cleaned
+                        batches[name].append(document)
+                        if len(batches[name]) >= batch_size:
+                            flush(name)
+                for name in batches:
+                    flush(name)
+                    flush_rejected(name)
+                if pending:
+                    drain(ALL_COMPLETED)
+            finally:
+                if executor is not None:
+                    executor.shutdown(wait=True)
+
+            # Index secondaires construits après le chargement (plus rapide qu'une maintenance à chaque insertion)
+            IndexManager(self.db).build_indexes(['transactions'], collection_names)
+            bump_load_generation(self.db)
+
+            elapsed = time.perf_counter() - start
+            total = sum(s['inserted'] for s in stats.values())
+            peak_rss = get_peak_rss_mb()
+
+            print(f"\nStatistiques d'import (streaming, lots de {batch_size}, {workers} worker(s)):")
+            for name, label in (('users', 'Utilisateurs importés'), ('transactions', 'Transactions importées')):
+                coll_stats = stats[name]
+                print(f"{label}: {coll_stats['inserted']} en {coll_stats['batches']} lots "
+                      f"({coll_stats['duplicates']} doublons, {coll_stats['errors']} autres erreurs)")
+                if transform is not None:
+                    print(f"  └── {coll_stats['rejected']} rejetés par le nettoyage (collection {quarantine_target})")
+            print(f"Débit: {total / elapsed if elapsed else 0:.0f} docs/s en {elapsed:.2f} s")
+            if peak_rss is not None:
+                print(f"Pic mémoire (RSS): {peak_rss:.1f} Mo")
+
+            return {
+                'collections': stats,
+                'elapsed': elapsed,
+                'docs_per_sec': total / elapsed if elapsed else 0,
+                'peak_rss_mb': peak_rss,
+            }
+
+        except Exception as e:
+            print(f"Erreur lors de l'import: {e}")
+            raise
+
+    def import_data(self, file_path, streaming=False, batch_size=DEFAULT_BATCH_SIZE, workers=1, transform=None,
+                    checkpoints=None, collection_names=None):
+        """Importe les données depuis le fichier JSON.
+
+        Seul l'import en streaming enregistre des points de reprise ; l'import
+        en un bloc est rejoué en entier.
+        """
+        if streaming or workers > 1 or transform is not None:
+            return self.stream_import_data(file_path, batch_size=batch_size, workers=workers,
+                                           transform=transform, checkpoints=checkpoints,
+                                           collection_names=collection_names)
+        names = collection_names or {}
+        users = self.db[names.get('users', 'users')]
+        transactions = self.db[names.get('transactions', 'transactions')]
         try:
             if not os.path.exists(file_path):
                 raise FileNotFoundError(f"Le fichier {file_path} n'existe pas")
@@ -45,15 +403,15 @@ class MongoDBConnection:
                 data = json.load(file)
             
             # Supprimer d'abord les collections existantes
-            self.drop_collections()
+            self.drop_collections(collection_names)
             
             # Créer un index unique sur email pour users
-            self.db.users.create_index("email", unique=True)
+            IndexManager(self.db).build_indexes(['users'], collection_names)
             
             # Insertion des utilisateurs
             if 'users' in data:
                 try:
-                    self.db.users.insert_many(data['users'], ordered=False)
+                    users.insert_many(data['users'], ordered=False)
                 except Exception as e:
                     print(f"Certains utilisateurs n'ont pas pu être insérés (doublons ignorés): {e}")
                 finally:
@@ -62,24 +420,52 @@ class MongoDBConnection:
             # Insertion des transactions
             if 'transactions' in data:
                 try:
-                    self.db.transactions.insert_many(data['transactions'], ordered=False)
+                    transactions.insert_many(data['transactions'], ordered=False)
                 except Exception as e:
                     print(f"Certaines transactions n'ont pas pu être insérées: {e}")
                 finally:
                     print(f"Import des transactions terminé")
             
+            IndexManager(self.db).build_indexes(['transactions'], collection_names)
+            bump_load_generation(self.db)
+
             # Afficher les statistiques finales
             print(f"\nStatistiques d'import:")
-            print(f"Utilisateurs importés: {self.db.users.count_documents({})}")
-            print(f"Transactions importées: {self.db.transactions.count_documents({})}")
+            print(f"Utilisateurs importés: {users.count_documents({})}")
+            print(f"Transactions importées: {transactions.count_documents({})}")
             
         except Exception as e:
             print(f"Erreur lors de l'import: {e}")
             raise
 
+    def swap_collections(self, collection_names):
+        """Met en service les collections fantômes par renameCollection(dropTarget=True).
+
+        Chaque renommage est atomique et emporte les index déjà construits :
+        les lecteurs voient l'ancienne puis la nouvelle collection, jamais une
+        collection vide ou partiellement chargée. users est basculé avant
+        transactions. Une collection fantôme absente (déjà basculée, ou
+        quarantaine d'un import sans nettoyage fusionné) est ignorée, ce qui
+        permet de rejouer une bascule interrompue. La quarantaine peut être vide.
+        """
+        existing = set(self.db.list_collection_names())
+        pending = {live: shadow for live, shadow in collection_names.items() if shadow in existing}
+        empty = [shadow for live, shadow in pending.items()
+                 if live != QUARANTINE_COLLECTION and self.db[shadow].estimated_document_count() == 0]
+        if empty:
+            raise RuntimeError(f"Collections fantômes vides, bascule annulée: {', '.join(empty)}")
+        for live, shadow in pending.items():
+            self.db[shadow].rename(live, dropTarget=True)
+            print(f"✓ {shadow} renommée en {live}")
+        if pending:
+            # La vue matérialisée décrit les données remplacées : elle sera recalculée
+            self.db[USER_STATS_COLLECTION].drop()
+            bump_load_generation(self.db)
+        return list(pending)
+
     def close(self):
-        """Ferme la connexion"""
-        if self.client:
+        """Ferme la connexion (un client partagé reste ouvert jusqu'à close_clients())"""
+        if self.client and not is_shared_client(self.client):
             self.client.close()
             print("Connexion fermée")
 
@@ -1,12 +1,64 @@
+import argparse
 import os
 import time
-from datetime import datetime
-from init_connection import MongoDBConnection
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from init_connection import (MongoDBConnection, DEFAULT_BATCH_SIZE, USER_STATS_COLLECTION, close_clients, get_client,
+                             staging_collection_names)
 from data_cleaning import DataCleaner
-from aggregations import DataAggregator
+from aggregations import DataAggregator, print_aggregation_results
+from indexes import IndexManager
+from metrics import PipelineMetrics
+from user_stats import UserStats
+from timeseries import TransactionTimeSeries, TIMESERIES_COLLECTION
+from parquet_export import ParquetExporter, DEFAULT_EXPORT_BATCH_SIZE
+from checkpoints import StageCheckpoints, source_fingerprint
 
 class DataPipeline:
-    def __init__(self):
+    def __init__(self, streaming_import=False, batch_size=DEFAULT_BATCH_SIZE, import_workers=1,
+                 cleaning_engine='python', incremental_cleaning=False, index_policy='warn',
+                 explain_indexes=False, aggregation_mode='separate', fused_ingest=False,
+                 collect_metrics=False, metrics_path=None, prometheus_path=None, materialized_stats=False,
+                 timeseries_collection=False, export_dir=None, export_batch_size=DEFAULT_EXPORT_BATCH_SIZE,
+                 resume=False, shadow_load=False, skip_import=False):
+        self.streaming_import = streaming_import
+        self.batch_size = batch_size
+        self.import_workers = import_workers
+        self.cleaning_engine = cleaning_engine
+        self.incremental_cleaning = incremental_cleaning
+        self.index_policy = index_policy
+        self.explain_indexes = explain_indexes
+        # 'separate' : une agrégation par rapport, 'combined' : un seul parcours $facet
+        self.aggregation_mode = aggregation_mode
+        # Nettoyage appliqué pendant l'import : chaque document n'est écrit qu'une fois
+        self.fused_ingest = fused_ingest
+        # Métriques par étape (commandes MongoDB, octets, documents, explain),
+        # exportées en JSON et/ou au format texte Prometheus
+        self.metrics = PipelineMetrics() if collect_metrics or metrics_path or prometheus_path else None
+        self.metrics_path = metrics_path
+        self.prometheus_path = prometheus_path
+        # Totaux et compteurs par utilisateur lus dans la vue matérialisée user_stats
+        self.materialized_stats = materialized_stats
+        # Copie des transactions nettoyées dans une collection time-series pour les rapports par fenêtre
+        self.timeseries_collection = timeseries_collection
+        # Export Parquet des données nettoyées (aucun export si None)
+        self.export_dir = export_dir
+        self.export_batch_size = export_batch_size
+        # Reprise après une exécution interrompue : les étapes terminées sont sautées,
+        # les étapes en cours repartent de leur dernier point de reprise (pipeline_state).
+        # Sans reprise, les points de reprise sont effacés et tout est reconstruit.
+        self.resume = resume
+        self.checkpoints = None
+        # Chargement et nettoyage dans users_staging / transactions_staging, puis bascule par
+        # renommage : les collections en service restent lisibles pendant toute la reconstruction
+        self.shadow_load = shadow_load
+        self.collection_names = staging_collection_names() if shadow_load else None
+        # Réutilise les collections existantes au lieu de les supprimer et de les réimporter :
+        # avec incremental_cleaning, seuls les documents nouveaux ou modifiés sont nettoyés
+        if skip_import and shadow_load:
+            raise ValueError("skip_import et shadow_load sont incompatibles : "
+                             "les collections fantômes sont reconstruites par l'import")
+        self.skip_import = skip_import
         self.start_time = None
         self.mongo_conn = None
         self.cleaner = None
@@ -24,16 +76,56 @@ class DataPipeline:
     def get_elapsed_time(self):
         return time.time() - self.start_time
 
+    def stage(self, name):
+        """Contexte de mesure d'une étape (sans effet si les métriques sont désactivées)"""
+        return self.metrics.stage(name) if self.metrics else nullcontext()
+
+    def run_stage(self, name, func):
+        """Exécute une étape reprenable : sautée si elle est déjà terminée, marquée terminée sinon"""
+        if self.checkpoints.is_done(name):
+            print(f"✓ Étape {name} déjà terminée (reprise)")
+            return None
+        with self.stage(name):
+            result = func()
+        self.checkpoints.complete(name)
+        return result
+
+    def prepare_checkpoints(self, json_path):
+        """Initialise les points de reprise ; une reprise exige le même fichier source"""
+        self.checkpoints = StageCheckpoints(self.mongo_conn.db)
+        fingerprint = source_fingerprint(json_path)
+        if self.resume and not self.checkpoints.source_matches(fingerprint):
+            print("⚠ Aucun import enregistré pour ce fichier source : reconstruction complète")
+            self.resume = False
+        if self.resume:
+            pending = [stage for stage, status in self.checkpoints.summary().items() if status != 'done']
+            print(f"Reprise de l'exécution précédente (étapes restantes: {', '.join(pending) or 'aucune'})")
+        else:
+            self.checkpoints.reset()
+        if not self.checkpoints.is_done('import'):
+            self.checkpoints.save('import', source=fingerprint)
+
     def init_connection(self):
         self.print_section("ÉTAPE 1: Connexion à MongoDB")
         try:
-            self.mongo_conn = MongoDBConnection()
+            # Avec les métriques, un client dédié porte l'écouteur de commandes
+            client = get_client(event_listeners=(self.metrics,)) if self.metrics else None
+            self.mongo_conn = MongoDBConnection(client=client)
             db = self.mongo_conn.connect()
             print("✓ Connexion établie avec succès")
             
             print("\nImport des données initial...")
             json_path = os.path.join(self.current_dir, 'users_transactions_with_issues.json')
-            self.mongo_conn.import_data(json_path)
+            self.prepare_checkpoints(json_path)
+            if self.skip_import:
+                self.checkpoints.complete('import', skipped=True)
+                print("✓ Import sauté : les collections existantes sont réutilisées")
+                return True
+            transform = DataCleaner.clean_for_ingest if self.fused_ingest else None
+            self.run_stage('import', lambda: self.mongo_conn.import_data(
+                json_path, streaming=self.streaming_import, batch_size=self.batch_size,
+                workers=self.import_workers, transform=transform, checkpoints=self.checkpoints,
+                collection_names=self.collection_names))
             print("✓ Import des données terminé")
                 
             return True
@@ -45,22 +137,31 @@ class DataPipeline:
     def clean_data(self):
         self.print_section("ÉTAPE 2: Nettoyage des données")
         try:
-            self.cleaner = DataCleaner()
+            self.cleaner = DataCleaner(batch_size=self.batch_size, engine=self.cleaning_engine,
+                                       incremental=self.incremental_cleaning, mongo_conn=self.mongo_conn,
+                                       checkpoints=self.checkpoints, collection_names=self.collection_names)
+
+            if self.fused_ingest and not self.skip_import:
+                print("✓ Utilisateurs et transactions nettoyés pendant l'import")
+                print("\nValidation des relations...")
+                self.run_stage('validate_relationships', self.cleaner.validate_relationships)
+                print("✓ Relations validées")
+                return True
             
             print("Nettoyage des utilisateurs...")
-            initial_users = self.cleaner.db.users.count_documents({})
-            self.cleaner.clean_users()
-            final_users = self.cleaner.db.users.count_documents({})
+            initial_users = self.cleaner.users.count_documents({})
+            self.run_stage('clean_users', self.cleaner.clean_users)
+            final_users = self.cleaner.users.count_documents({})
             print(f"✓ {initial_users - final_users} utilisateurs nettoyés")
             
             print("\nNettoyage des transactions...")
-            initial_transactions = self.cleaner.db.transactions.count_documents({})
-            self.cleaner.clean_transactions()
-            final_transactions = self.cleaner.db.transactions.count_documents({})
+            initial_transactions = self.cleaner.transactions.count_documents({})
+            self.run_stage('clean_transactions', self.cleaner.clean_transactions)
+            final_transactions = self.cleaner.transactions.count_documents({})
             print(f"✓ {initial_transactions - final_transactions} transactions nettoyées")
             
             print("\nValidation des relations...")
-            self.cleaner.validate_relationships()
+            self.run_stage('validate_relationships', self.cleaner.validate_relationships)
             print("✓ Relations validées")
             
             return True
@@ -68,38 +169,119 @@ class DataPipeline:
             print(f"✗ Erreur lors du nettoyage: {e}")
             return False
 
+    def swap_collections(self):
+        print("\nBascule des collections fantômes...")
+        try:
+            self.run_stage('swap', lambda: self.mongo_conn.swap_collections(self.collection_names))
+            print("✓ Nouvelles données en service")
+            return True
+        except Exception as e:
+            print(f"✗ Erreur lors de la bascule: {e}")
+            return False
+
     def run_aggregations(self):
         self.print_section("ÉTAPE 3: Analyses et Agrégations")
+        if self.checkpoints.is_done('aggregations'):
+            print("✓ Étape aggregations déjà terminée (reprise)")
+            return True
         try:
-            self.aggregator = DataAggregator()
-            
-            # Agrégation 1
-            print("1. Top 10 utilisateurs par montant total dépensé:")
-            print("-" * 50)
-            for idx, result in enumerate(list(self.aggregator.total_spent_by_user())[:10], 1):
-                print(f"{idx}. {result['first_name']} {result['last_name']}: {result['total_spent']:.2f}€")
-            
-            print("\n2. Utilisateurs avec 3 transactions ou plus:")
-            print("-" * 50)
-            for idx, result in enumerate(self.aggregator.users_with_multiple_transactions(), 1):
-                print(f"{idx}. {result['first_name']} {result['last_name']}: {result['transaction_count']} transactions")
-            
-            print("\n3. Analyse des statuts de transaction:")
-            print("-" * 50)
-            for result in self.aggregator.transaction_status_patterns():
-                print(f"Status {result['_id']:<10}: {result['count']:>5} transactions, "
-                      f"montant moyen: {result['avg_amount']:>8.2f}€")
+            if self.materialized_stats:
+                with self.stage('user_stats'):
+                    UserStats(self.mongo_conn.db, batch_size=self.batch_size).refresh()
+            if self.timeseries_collection:
+                with self.stage('timeseries'):
+                    TransactionTimeSeries(self.mongo_conn.db, batch_size=self.batch_size).load()
+            self.aggregator = DataAggregator(index_policy=self.index_policy, mongo_conn=self.mongo_conn,
+                                             use_user_stats=self.materialized_stats)
+            if self.explain_indexes:
+                IndexManager(self.aggregator.db).explain_aggregations(self.aggregator)
+
+            with self.stage('aggregations'):
+                if self.aggregation_mode == 'combined':
+                    with self.stage('aggregations.combined_report'):
+                        report = self.aggregator.combined_report(top_n=10)
+                    top_spenders = report['top_spenders']
+                    frequent_users = report['frequent_users']
+                    status_patterns = report['status_patterns']
+                else:
+                    # Résultats matérialisés dans chaque étape pour y rattacher tous les getMore
+                    with self.stage('aggregations.total_spent_by_user'):
+                        top_spenders = list(self.aggregator.total_spent_by_user(limit=10))
+                    with self.stage('aggregations.users_with_multiple_transactions'):
+                        frequent_users = list(self.aggregator.users_with_multiple_transactions())
+                    with self.stage('aggregations.transaction_status_patterns'):
+                        status_patterns = list(self.aggregator.transaction_status_patterns())
+                with self.stage('aggregations.users_without_transactions'):
+                    inactive_users = list(self.aggregator.users_without_transactions())
+                with self.stage('aggregations.volume_by_period'):
+                    daily_volume = self.last_days_volume(days=7)
+            if self.metrics:
+                self.record_aggregation_explains()
             
-            print("\n4. Utilisateurs sans transactions:")
+            print_aggregation_results(top_spenders, frequent_users, status_patterns, inactive_users)
+
+            print("\n5. Volume quotidien (7 derniers jours de données):")
             print("-" * 50)
-            for idx, result in enumerate(self.aggregator.users_without_transactions(), 1):
-                print(f"{idx}. {result['first_name']} {result['last_name']}")
-            
+            for result in daily_volume:
+                print(f"{result['_id']:%Y-%m-%d}: {result['count']:>5} transactions, "
+                      f"montant total: {result['total_amount']:>10.2f}€")
+
+            self.checkpoints.complete('aggregations')
             return True
         except Exception as e:
             print(f"✗ Erreur lors des agrégations: {e}")
             return False
 
+    def export_data(self):
+        self.print_section("ÉTAPE 4: Export Parquet")
+        try:
+            self.run_stage('export', ParquetExporter(self.mongo_conn.db, self.export_dir,
+                                                     batch_size=self.export_batch_size).export_all)
+            return True
+        except Exception as e:
+            print(f"✗ Erreur lors de l'export Parquet: {e}")
+            return False
+
+    def last_days_volume(self, days=7):
+        """Volume quotidien sur les `days` derniers jours précédant la transaction la plus récente"""
+        latest = self.aggregator.db.transactions.find_one({'timestamp': {'$type': 'date'}},
+                                                          {'timestamp': 1}, sort=[('timestamp', -1)])
+        if latest is None:
+            return []
+        end = latest['timestamp'].replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        collection = TIMESERIES_COLLECTION if self.timeseries_collection else 'transactions'
+        return list(self.aggregator.volume_by_period('day', start=end - timedelta(days=days), end=end,
+                                                     collection=collection))
+
+    def record_aggregation_explains(self):
+        """Temps d'exécution serveur (explain) de chaque agrégation exécutée"""
+        queries = DataAggregator.queries()
+        if self.materialized_stats:
+            # users_without_transactions() lit alors user_stats, quel que soit le mode d'agrégation
+            queries['users_without_transactions'] = (
+                'users', DataAggregator.users_without_transactions_pipeline('stats'))
+        if self.aggregation_mode == 'combined':
+            queries = {'combined_report': ('transactions', DataAggregator.combined_report_pipeline(top_n=10)),
+                       'users_without_transactions': queries['users_without_transactions']}
+        elif self.materialized_stats:
+            queries['total_spent_by_user'] = (USER_STATS_COLLECTION, DataAggregator.total_spent_from_stats_pipeline(limit=10))
+            queries['users_with_multiple_transactions'] = (
+                USER_STATS_COLLECTION, DataAggregator.users_with_multiple_transactions_from_stats_pipeline())
+        else:
+            queries['total_spent_by_user'] = ('transactions', DataAggregator.total_spent_by_user_pipeline(limit=10))
+        for name, (collection, pipeline) in queries.items():
+            self.metrics.record_explain(f'aggregations.{name}', self.aggregator.db, collection, pipeline)
+
+    def report_metrics(self):
+        print("\nMétriques par étape:")
+        self.metrics.print_summary()
+        if self.metrics_path:
+            self.metrics.to_json(self.metrics_path)
+            print(f"✓ Rapport JSON écrit dans {self.metrics_path}")
+        if self.prometheus_path:
+            self.metrics.to_prometheus(self.prometheus_path)
+            print(f"✓ Métriques Prometheus écrites dans {self.prometheus_path}")
+
     def generate_report(self):
         self.print_section("RAPPORT FINAL")
         elapsed_time = self.get_elapsed_time()
@@ -115,6 +297,7 @@ class DataPipeline:
         """Nettoie les ressources"""
         if self.mongo_conn:
             self.mongo_conn.close()
+        close_clients()
 
     def run(self):
         """Exécute le pipeline complet"""
@@ -126,17 +309,36 @@ class DataPipeline:
             
             if not self.clean_data():
                 return
+
+            if self.shadow_load and not self.swap_collections():
+                return
             
             if not self.run_aggregations():
                 return
+
+            if self.export_dir and not self.export_data():
+                return
             
             self.generate_report()
             
         finally:
+            # Les métriques sont émises même si une étape échoue
+            if self.metrics:
+                self.report_metrics()
             self.cleanup()
 
 def main():
-    pipeline = DataPipeline()
+    parser = argparse.ArgumentParser(description="Pipeline MongoDB")
+    parser.add_argument('--resume', action='store_true',
+                        help="reprend l'exécution interrompue depuis ses points de reprise "
+                             "(par défaut : reconstruction complète)")
+    parser.add_argument('--skip-import', action='store_true',
+                        help="réutilise les collections existantes sans réimport et ne nettoie que "
+                             "les documents nouveaux ou modifiés (nettoyage incrémental)")
+    args = parser.parse_args()
+
+    pipeline = DataPipeline(resume=args.resume, skip_import=args.skip_import,
+                            incremental_cleaning=args.skip_import)
     pipeline.run()
 
 if __name__ == "__main__":
@@ -0,0 +1,300 @@
+import json
+import math
+import threading
+from collections import deque
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import bson
+from pymongo import monitoring
+from tabulate import tabulate
+
+# Commandes dont la réponse transporte des documents lus (curseur)
+READ_COMMANDS = ('find', 'aggregate', 'getMore')
+# Commandes d'écriture : champ de la réponse donnant le nombre de documents écrits
+WRITE_COMMANDS = {'insert': 'n', 'update': 'nModified', 'delete': 'n'}
+# Étape à laquelle sont rattachées les commandes émises hors de toute étape
+UNTRACKED_STAGE = 'untracked'
+
+def percentile(values, p):
+    """Percentile au rang le plus proche"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def _empty_stage():
+    return {
+        'wall_time_s': 0.0,
+        'round_trips': 0,
+        'failed_commands': 0,
+        'command_time_ms': 0.0,
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'docs_read': 0,
+        'docs_written': 0,
+        'commands': {},
+    }
+
+def _bson_size(document):
+    try:
+        return len(bson.encode(document))
+    except Exception:
+        return 0
+
+def _docs_read(reply):
+    cursor = reply.get('cursor') or {}
+    return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+
+def explain_execution_ms(db, collection, pipeline):
+    """Temps d'exécution serveur (ms) d'une agrégation, via explain en mode executionStats.
+
+    Selon la forme du plan, le temps est donné par executionStats.executionTimeMillis
+    ou par les estimations cumulées de chaque étape : on retient la plus grande valeur.
+    """
+    explain = db.command('explain', {'aggregate': collection, 'pipeline': pipeline, 'cursor': {}},
+                         verbosity='executionStats')
+    times = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key in ('executionTimeMillis', 'executionTimeMillisEstimate') and isinstance(value, (int, float)):
+                    times.append(value)
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(explain)
+    return max(times) if times else None
+
+class PipelineMetrics(monitoring.CommandListener):
+    """Instrumentation par étape d'un pipeline.
+
+    Enregistré comme écouteur de commandes sur le MongoClient
+    (`event_listeners=(metrics,)`), il attribue chaque aller-retour à l'étape
+    en cours : durée côté client, octets envoyés et reçus (taille BSON des
+    commandes et des réponses), documents lus et écrits. Les étapes étant
+    séquentielles, l'étape courante est partagée par tous les threads (les
+    workers de l'import y compris). Une sous-étape (nom pointé, par exemple
+    'aggregations.total_spent_by_user') reçoit ses propres commandes et sa
+    durée reste comptée dans celle de l'étape parente.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.current_stage = UNTRACKED_STAGE
+        self.started_at = datetime.now(timezone.utc)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def stage_stats(self, name):
+        with self._lock:
+            return self.stages.setdefault(name, _empty_stage())
+
+    @contextmanager
+    def stage(self, name):
+        """Rattache à `name` les commandes émises dans le bloc et mesure sa durée"""
+        stats = self.stage_stats(name)
+        previous = self.current_stage
+        self.current_stage = name
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats['wall_time_s'] += time.perf_counter() - start
+            self.current_stage = previous
+
+    def record_explain(self, name, db, collection, pipeline):
+        """Ajoute à l'étape le temps d'exécution serveur mesuré par explain"""
+        try:
+            # Les commandes explain sont comptées à part pour ne pas fausser l'étape mesurée
+            with self.stage('explain'):
+                server_time = explain_execution_ms(db, collection, pipeline)
+            self.stage_stats(name)['server_time_ms'] = server_time
+        except Exception as e:
+            print(f"⚠ explain impossible pour {name}: {e}")
+
+    # Écouteur de commandes PyMongo
+
+    def started(self, event):
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (
+                self.current_stage, _bson_size(event.command))
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+    def _finish(self, event, failed):
+        with self._lock:
+            stage, bytes_sent = self._pending.pop((event.connection_id, event.request_id),
+                                                  (self.current_stage, 0))
+            stats = self.stages.setdefault(stage, _empty_stage())
+            stats['round_trips'] += 1
+            stats['commands'][event.command_name] = stats['commands'].get(event.command_name, 0) + 1
+            stats['command_time_ms'] += event.duration_micros / 1000
+            stats['bytes_sent'] += bytes_sent
+            if failed:
+                stats['failed_commands'] += 1
+                return
+            reply = event.reply
+            stats['bytes_received'] += _bson_size(reply)
+            if event.command_name in READ_COMMANDS:
+                stats['docs_read'] += _docs_read(reply)
+            elif event.command_name in WRITE_COMMANDS:
+                stats['docs_written'] += reply.get(WRITE_COMMANDS[event.command_name], 0)
+
+    # Rapports
+
+    def report(self):
+        with self._lock:
+            stages = {name: {**stats, 'commands': dict(stats['commands'])}
+                      for name, stats in self.stages.items()}
+        return {
+            'started_at': self.started_at.isoformat(),
+            'total_wall_time_s': sum(stats['wall_time_s'] for name, stats in stages.items()
+                                     if '.' not in name),
+            'stages': stages,
+        }
+
+    def to_json(self, path=None):
+        """Rapport JSON ; écrit dans `path` si fourni"""
+        text = json.dumps(self.report(), indent=2, ensure_ascii=False)
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        return text
+
+    def to_prometheus(self, path=None, prefix='pipeline'):
+        """Rapport au format texte Prometheus ; écrit dans `path` si fourni"""
+        metrics = [
+            ('stage_wall_seconds', 'wall_time_s', 'Durée de l\'étape en secondes'),
+            ('stage_round_trips_total', 'round_trips', 'Allers-retours vers le serveur'),
+            ('stage_failed_commands_total', 'failed_commands', 'Commandes en échec'),
+            ('stage_command_seconds', 'command_time_ms', 'Durée cumulée des commandes vue du client'),
+            ('stage_bytes_sent_total', 'bytes_sent', 'Octets BSON envoyés'),
+            ('stage_bytes_received_total', 'bytes_received', 'Octets BSON reçus'),
+            ('stage_docs_read_total', 'docs_read', 'Documents lus'),
+            ('stage_docs_written_total', 'docs_written', 'Documents écrits'),
+            ('stage_server_seconds', 'server_time_ms', 'Temps d\'exécution serveur mesuré par explain'),
+        ]
+        stages = self.report()['stages']
+        lines = []
+        for suffix, field, help_text in metrics:
+            name = f'{prefix}_{suffix}'
+            kind = 'counter' if suffix.endswith('_total') else 'gauge'
+            samples = []
+            for stage, stats in stages.items():
+                value = stats.get(field)
+                if value is None:
+                    continue
+                if field.endswith('_ms'):
+                    value = value / 1000
+                samples.append(f'{name}{{stage="{stage}"}} {value}')
+            if samples:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}'] + samples
+        text = '\n'.join(lines) + '\n'
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        return text
+
+    def print_summary(self):
+        rows = [[name, f"{s['wall_time_s']:.3f}", s['round_trips'], s['docs_read'], s['docs_written'],
+                 f"{(s['bytes_sent'] + s['bytes_received']) / 1024:.1f}",
+                 '' if s.get('server_time_ms') is None else s['server_time_ms']]
+                for name, s in self.report()['stages'].items()]
+        print(tabulate(rows, headers=['Étape', 'Durée (s)', 'Allers-retours', 'Docs lus',
+                                      'Docs écrits', 'Ko transférés', 'Serveur (ms)'], tablefmt='grid'))
+
+class StreamMetrics:
+    """Métriques du service de change streams (voir change_stream_service.py).
+
+    Compteurs cumulés (événements, micro-lots, documents nettoyés ou
+    supprimés, agrégats recalculés) et, sur les `window` dernières mesures,
+    le retard de bout en bout (de l'écriture d'origine, `wallTime` de
+    l'événement, à la fin du micro-lot qui l'a traitée) et la durée des
+    micro-lots.
+    """
+
+    COUNTERS = ('events', 'batches', 'cleaned', 'deleted', 'write_errors', 'users_refreshed',
+                'statuses_refreshed', 'unattributed_deletes')
+
+    def __init__(self, window=10_000):
+        self.started_at = datetime.now(timezone.utc)
+        self._start = time.monotonic()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.lags = deque(maxlen=window)
+        self.batch_times = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_batch(self, lags, elapsed, **counts):
+        """Enregistre un micro-lot : retards de ses événements (s), durée (s) et compteurs"""
+        with self._lock:
+            self.counters['events'] += len(lags)
+            self.counters['batches'] += 1
+            for name, value in counts.items():
+                self.counters[name] += value
+            self.lags.extend(lags)
+            self.batch_times.append(elapsed)
+
+    def report(self):
+        with self._lock:
+            uptime = time.monotonic() - self._start
+            lags = list(self.lags)
+            batch_times = list(self.batch_times)
+            counters = dict(self.counters)
+        return {
+            'started_at': self.started_at.isoformat(),
+            'uptime_s': uptime,
+            **counters,
+            'events_per_sec': counters['events'] / uptime if uptime else 0.0,
+            'lag_last_s': lags[-1] if lags else None,
+            'lag_p50_s': percentile(lags, 50) if lags else None,
+            'lag_p95_s': percentile(lags, 95) if lags else None,
+            'lag_max_s': max(lags) if lags else None,
+            'batch_p50_s': percentile(batch_times, 50) if batch_times else None,
+        }
+
+    def to_prometheus(self, path=None, prefix='change_stream'):
+        """Rapport au format texte Prometheus ; écrit dans `path` si fourni"""
+        report = self.report()
+        metrics = [(f'{name}_total', name, 'counter') for name in self.COUNTERS] + [
+            ('events_per_second', 'events_per_sec', 'gauge'),
+            ('lag_seconds{quantile="0.5"}', 'lag_p50_s', 'summary'),
+            ('lag_seconds{quantile="0.95"}', 'lag_p95_s', 'summary'),
+            ('lag_seconds{quantile="1"}', 'lag_max_s', 'summary'),
+            ('batch_seconds{quantile="0.5"}', 'batch_p50_s', 'summary'),
+        ]
+        lines = []
+        declared = set()
+        for suffix, field, kind in metrics:
+            if report[field] is None:
+                continue
+            name = f'{prefix}_{suffix}'
+            base = name.split('{')[0]
+            if base not in declared:
+                lines.append(f'# TYPE {base} {kind}')
+                declared.add(base)
+            lines.append(f'{name} {report[field]}')
+        text = '\n'.join(lines) + '\n'
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        return text
+
+    def print_summary(self):
+        report = self.report()
+
+        def seconds(value):
+            return '' if value is None else f"{value:.3f}"
+
+        print(tabulate([[report['events'], report['batches'], f"{report['events_per_sec']:.1f}",
+                         seconds(report['lag_p50_s']), seconds(report['lag_p95_s']), seconds(report['lag_max_s']),
+                         report['cleaned'], report['deleted'], report['users_refreshed']]],
+                       headers=['Événements', 'Micro-lots', 'Évén./s', 'Retard p50 (s)', 'Retard p95 (s)',
+                                'Retard max (s)', 'Nettoyés', 'Supprimés', 'Utilisateurs recalculés'],
+                       tablefmt='grid'))
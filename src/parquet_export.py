@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import time
+import pyarrow as pa
+import pyarrow.dataset as ds
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Taille des lots du curseur et des record batches Arrow
+DEFAULT_EXPORT_BATCH_SIZE = 50_000
+
+USERS_SCHEMA = pa.schema([
+    ('_id', pa.string()),
+    ('first_name', pa.string()),
+    ('last_name', pa.string()),
+    ('email', pa.string()),
+    ('gender', pa.string()),
+    ('phone', pa.string()),
+])
+
+TRANSACTIONS_SCHEMA = pa.schema([
+    ('_id', pa.string()),
+    ('user_id', pa.string()),
+    ('amount', pa.float64()),
+    ('timestamp', pa.timestamp('ms', tz='UTC')),
+    ('status', pa.string()),
+    ('date', pa.string()),
+])
+
+# Partitionnement Hive des transactions : status=SUCCESS/date=2024-10-24/...
+TRANSACTIONS_PARTITIONING = ds.partitioning(pa.schema([('status', pa.string()), ('date', pa.string())]),
+                                            flavor='hive')
+
+def _open_files_limit(wanted):
+    """Borne `wanted` par la limite de descripteurs du processus (moins une marge pour le reste)"""
+    if resource is None:
+        return wanted
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+    return max(1, min(wanted, soft - 64))
+
+def _as_text(value):
+    return None if value is None else str(value)
+
+def _as_float(value):
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+class ParquetExporter:
+    """Export colonnaire des collections nettoyées vers Parquet.
+
+    Les documents sont lus par curseur avec une projection et un grand
+    `batch_size`, convertis en record batches Arrow puis écrits au fil de
+    l'eau par pyarrow.dataset : la mémoire reste bornée par un lot. Les
+    transactions sont partitionnées par statut et par jour. Chaque collection
+    est écrite dans un répertoire temporaire qui remplace ensuite l'export
+    précédent en entier, sans laisser de partition périmée.
+    """
+
+    def __init__(self, db, output_dir, batch_size=DEFAULT_EXPORT_BATCH_SIZE):
+        self.db = db
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.stats = {}
+
+    def record_batches(self, collection_name, schema, to_row):
+        """Parcourt la collection et produit des pa.RecordBatch de `batch_size` lignes"""
+        fields = [name for name in schema.names if name != 'date']
+        projection = {name: 1 for name in fields}
+        columns = {name: [] for name in schema.names}
+        rows = 0
+        for doc in self.db[collection_name].find({}, projection, batch_size=self.batch_size):
+            for name, value in to_row(doc).items():
+                columns[name].append(value)
+            rows += 1
+            if len(columns['_id']) >= self.batch_size:
+                yield pa.RecordBatch.from_pydict(columns, schema=schema)
+                columns = {name: [] for name in schema.names}
+        if columns['_id']:
+            yield pa.RecordBatch.from_pydict(columns, schema=schema)
+        self.stats[collection_name] = {'rows': rows}
+
+    @staticmethod
+    def user_row(doc):
+        return {name: _as_text(doc.get(name)) for name in USERS_SCHEMA.names}
+
+    @staticmethod
+    def transaction_row(doc):
+        timestamp = doc.get('timestamp')
+        if not hasattr(timestamp, 'date'):
+            # Timestamp absent ou non converti (export avant nettoyage)
+            timestamp = None
+        return {
+            '_id': _as_text(doc.get('_id')),
+            'user_id': _as_text(doc.get('user_id')),
+            'amount': _as_float(doc.get('amount')),
+            'timestamp': timestamp,
+            'status': _as_text(doc.get('status')),
+            'date': timestamp.strftime('%Y-%m-%d') if timestamp else None,
+        }
+
+    def write_staging(self, collection_name, schema, to_row, partitioning=None):
+        """Écrit la collection dans un répertoire temporaire de `output_dir` et retourne son chemin.
+
+        Un lot de `batch_size` lignes touche au plus `batch_size` partitions :
+        `max_partitions` ne peut donc pas être dépassé, quelle que soit la
+        période couverte (pyarrow refuse par défaut plus de 1024 partitions
+        par lot, soit moins d'un an de transactions sur trois statuts).
+        """
+        start = time.perf_counter()
+        staging = tempfile.mkdtemp(prefix=f'.{collection_name}.', dir=self.output_dir)
+        try:
+            ds.write_dataset(self.record_batches(collection_name, schema, to_row), staging, schema=schema,
+                             format='parquet', partitioning=partitioning,
+                             existing_data_behavior='overwrite_or_ignore',
+                             max_partitions=self.batch_size,
+                             max_open_files=_open_files_limit(self.batch_size))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.stats[collection_name]['elapsed'] = time.perf_counter() - start
+        return staging
+
+    def publish(self, collection_name, staging):
+        """Remplace l'export précédent de la collection par le répertoire écrit"""
+        target = os.path.join(self.output_dir, collection_name)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.rename(staging, target)
+        stats = self.stats[collection_name]
+        stats.update({'path': target, 'rows_per_sec': stats['rows'] / stats['elapsed'] if stats['elapsed'] else 0})
+        print(f"✓ {collection_name}: {stats['rows']} lignes exportées vers {target} "
+              f"en {stats['elapsed']:.2f} s ({stats['rows_per_sec']:.0f} lignes/s)")
+        return stats
+
+    def export_collection(self, collection_name, schema, to_row, partitioning=None):
+        return self.publish(collection_name, self.write_staging(collection_name, schema, to_row, partitioning))
+
+    def export_all(self):
+        """Exporte users (un jeu non partitionné) et transactions (partitionné par statut et par jour).
+
+        Les deux collections sont écrites avant de remplacer l'export précédent :
+        un échec laisse l'ancien export intact au lieu d'un mélange des deux.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        exports = [('users', USERS_SCHEMA, self.user_row, None),
+                   ('transactions', TRANSACTIONS_SCHEMA, self.transaction_row, TRANSACTIONS_PARTITIONING)]
+        written = {}
+        try:
+            for collection_name, schema, to_row, partitioning in exports:
+                written[collection_name] = self.write_staging(collection_name, schema, to_row, partitioning)
+        except BaseException:
+            for staging in written.values():
+                shutil.rmtree(staging, ignore_errors=True)
+            raise
+        for collection_name, staging in written.items():
+            self.publish(collection_name, staging)
+        return self.stats
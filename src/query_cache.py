@@ -0,0 +1,87 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from bson import json_util
+from init_connection import load_generation
+
+DEFAULT_MAX_ENTRIES = 128
+DEFAULT_TTL_SECONDS = 300
+
+class QueryCache:
+    """Cache LRU en mémoire des résultats d'agrégation, avec durée de vie.
+
+    La clé est dérivée de la base, de la collection et du pipeline (qui
+    contient déjà les paramètres : limit, skip, seuils...). Chaque entrée
+    mémorise l'état des données au moment du calcul : le compteur de
+    génération (incrémenté par l'import, le nettoyage et user_stats) et le
+    nombre estimé de documents des collections sources. Une entrée dont
+    l'état ne correspond plus est recalculée, même avant l'expiration.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL_SECONDS,
+                 collections=('users', 'transactions')):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Collections dont le nombre de documents entre dans l'état de validité
+        self.collections = collections
+        self.entries = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'expirations': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(db, collection, pipeline):
+        payload = json_util.dumps([db.name, collection, pipeline])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def data_version(self, db):
+        """État des données : (génération, nombres estimés de documents)"""
+        return (load_generation(db),) + tuple(db[name].estimated_document_count() for name in self.collections)
+
+    def get_or_compute(self, db, collection, pipeline, compute):
+        """Résultat en cache pour ce pipeline, ou calculé par `compute()` puis mis en cache"""
+        key = self.make_key(db, collection, pipeline)
+        version = self.data_version(db)
+        now = time.monotonic()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry_version, expires_at, value = entry
+                if entry_version != version:
+                    self.counters['invalidations'] += 1
+                elif expires_at <= now:
+                    self.counters['expirations'] += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.counters['hits'] += 1
+                    return value
+                del self.entries[key]
+            self.counters['misses'] += 1
+
+        value = compute()
+        with self._lock:
+            self.entries[key] = (version, time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {
+                **self.counters,
+                'entries': len(self.entries),
+                'hit_ratio': self.counters['hits'] / lookups if lookups else 0.0,
+            }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f"Cache des agrégations: {stats['hits']} hits, {stats['misses']} misses "
+              f"(taux {stats['hit_ratio']:.0%}), {stats['invalidations']} invalidations, "
+              f"{stats['expirations']} expirations, {stats['evictions']} évictions, {stats['entries']} entrées")
@@ -0,0 +1,68 @@
+import time
+from pymongo.errors import BulkWriteError
+from init_connection import DEFAULT_BATCH_SIZE, bump_load_generation
+
+TIMESERIES_COLLECTION = 'transactions_ts'
+
+class TransactionTimeSeries:
+    """Copie des transactions nettoyées dans une collection time-series (MongoDB 5.0+).
+
+    `timestamp` est le champ de temps et `user_id` la métadonnée : MongoDB
+    regroupe les mesures d'un même utilisateur par tranches de temps et les
+    stocke en colonnes compressées, ce qui accélère les rapports par fenêtre.
+    Seules les transactions dont le timestamp est une date BSON (donc
+    nettoyées) sont copiées.
+    """
+
+    def __init__(self, db, batch_size=DEFAULT_BATCH_SIZE, granularity='hours'):
+        self.db = db
+        self.batch_size = batch_size
+        self.granularity = granularity
+        self.collection = db[TIMESERIES_COLLECTION]
+
+    def create(self):
+        """(Re)crée la collection time-series"""
+        self.collection.drop()
+        self.db.create_collection(TIMESERIES_COLLECTION, timeseries={
+            'timeField': 'timestamp',
+            'metaField': 'user_id',
+            'granularity': self.granularity,
+        })
+        # Index secondaire sur (métadonnée, temps) pour les rapports d'un utilisateur
+        self.collection.create_index([('user_id', 1), ('timestamp', 1)])
+
+    def load(self):
+        """Recharge la collection depuis transactions, par lots insert_many"""
+        start = time.perf_counter()
+        self.create()
+        inserted = 0
+        errors = 0
+        batch = []
+
+        def flush():
+            nonlocal inserted, errors, batch
+            if not batch:
+                return
+            try:
+                inserted += len(self.collection.insert_many(batch, ordered=False).inserted_ids)
+            except BulkWriteError as e:
+                inserted += e.details.get('nInserted', 0)
+                errors += len(e.details.get('writeErrors', []))
+            batch = []
+
+        projection = {'_id': 1, 'user_id': 1, 'timestamp': 1, 'amount': 1, 'status': 1}
+        try:
+            for tx in self.db.transactions.find({'timestamp': {'$type': 'date'}}, projection,
+                                                batch_size=self.batch_size):
+                batch.append(tx)
+                if len(batch) >= self.batch_size:
+                    flush()
+            flush()
+        finally:
+            # La collection a été recréée : invalide les résultats en cache qui la lisent
+            bump_load_generation(self.db)
+
+        elapsed = time.perf_counter() - start
+        print(f"✓ {inserted} transactions chargées dans {TIMESERIES_COLLECTION} "
+              f"({errors} erreurs) en {elapsed:.2f} s")
+        return {'inserted': inserted, 'errors': errors, 'elapsed': elapsed}
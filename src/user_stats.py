@@ -0,0 +1,163 @@
+import time
+import uuid
+from pymongo import DESCENDING, IndexModel
+from init_connection import DEFAULT_BATCH_SIZE, USER_STATS_COLLECTION, STATE_COLLECTION, bump_load_generation
+
+# Champ de filigrane : posé par le nettoyage sur chaque transaction créée ou retraitée
+WATERMARK_FIELD = 'cleaned_at'
+
+USER_STATS_INDEXES = [
+    IndexModel([('total_spent', DESCENDING)], name='total_spent_-1'),
+    IndexModel([('transaction_count', DESCENDING)], name='transaction_count_-1'),
+]
+
+def build_user_stats_pipeline(match=None):
+    """Résumé par utilisateur : total dépensé, nombre de transactions, nombre par statut
+    et timestamp de la dernière transaction"""
+    pipeline = [{'$match': match}] if match else [{'$sort': {'user_id': 1}}]
+    return pipeline + [
+        {'$group': {
+            '_id': {'user_id': '$user_id', 'status': '$status'},
+            'total_spent': {'$sum': '$amount'},
+            'transaction_count': {'$sum': 1},
+            'last_transaction_at': {'$max': '$timestamp'}
+        }},
+        {'$group': {
+            '_id': '$_id.user_id',
+            'total_spent': {'$sum': '$total_spent'},
+            'transaction_count': {'$sum': '$transaction_count'},
+            'status_counts': {'$push': {
+                'k': {'$ifNull': [{'$toString': '$_id.status'}, 'null']},
+                'v': '$transaction_count'
+            }},
+            'last_transaction_at': {'$max': '$last_transaction_at'}
+        }},
+        {'$set': {'status_counts': {'$arrayToObject': '$status_counts'}}}
+    ]
+
+class UserStats:
+    """Vue matérialisée `user_stats`, alimentée par $merge depuis transactions.
+
+    Le premier calcul (ou `refresh(full=True)`) regroupe toutes les transactions.
+    Les suivants ne recalculent que les utilisateurs ayant une transaction dont
+    `cleaned_at` est postérieur au filigrane enregistré : chaque utilisateur
+    touché est recalculé en entier via l'index user_id puis remplacé, ce qui
+    reste juste pour les transactions modifiées. Les suppressions de
+    transactions ne sont prises en compte que par un recalcul complet.
+    """
+
+    def __init__(self, db, batch_size=DEFAULT_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.collection = db[USER_STATS_COLLECTION]
+
+    def ensure_indexes(self):
+        self.collection.create_indexes(USER_STATS_INDEXES)
+        self.db.transactions.create_index(WATERMARK_FIELD)
+
+    def watermark(self):
+        state = self.db[STATE_COLLECTION].find_one({'_id': USER_STATS_COLLECTION})
+        return state.get('watermark') if state else None
+
+    def latest_change(self):
+        """Valeur la plus récente du champ de filigrane dans transactions"""
+        latest = self.db.transactions.find_one({WATERMARK_FIELD: {'$ne': None}},
+                                               {WATERMARK_FIELD: 1}, sort=[(WATERMARK_FIELD, DESCENDING)])
+        return latest[WATERMARK_FIELD] if latest else None
+
+    def merge(self, match, refresh_id):
+        merge_stages = [
+            {'$set': {'refresh_id': refresh_id}},
+            {'$merge': {'into': USER_STATS_COLLECTION, 'on': '_id',
+                        'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+        ]
+        self.db.transactions.aggregate(build_user_stats_pipeline(match) + merge_stages, allowDiskUse=True)
+
+    def changed_user_ids(self, since):
+        """user_id des transactions modifiées depuis `since`, par lots de batch_size"""
+        batch = []
+        # $gte : les transactions marquées à l'instant exact du filigrane sont retraitées (idempotent)
+        for doc in self.db.transactions.aggregate([
+            {'$match': {WATERMARK_FIELD: {'$gte': since}}},
+            {'$group': {'_id': '$user_id'}}
+        ], allowDiskUse=True):
+            batch.append(doc['_id'])
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def refresh(self, full=False):
+        """Met à jour user_stats ; retourne le mode utilisé et le nombre d'utilisateurs recalculés"""
+        start = time.perf_counter()
+        self.ensure_indexes()
+        watermark = self.watermark()
+        # Lu avant le calcul : une transaction marquée pendant le calcul sera reprise au prochain passage
+        latest = self.latest_change()
+        if watermark is None or self.collection.estimated_document_count() == 0:
+            full = True
+
+        refresh_id = uuid.uuid4().hex
+        if full:
+            self.merge(None, refresh_id)
+            # Utilisateurs qui n'ont plus aucune transaction
+            self.collection.delete_many({'refresh_id': {'$ne': refresh_id}})
+            refreshed = self.collection.count_documents({})
+        else:
+            refreshed = 0
+            for user_ids in self.changed_user_ids(watermark):
+                self.merge({'user_id': {'$in': user_ids}}, refresh_id)
+                refreshed += len(user_ids)
+
+        if latest is not None:
+            self.db[STATE_COLLECTION].update_one({'_id': USER_STATS_COLLECTION},
+                                                 {'$set': {'watermark': latest}}, upsert=True)
+        bump_load_generation(self.db)
+        mode = 'complet' if full else 'incrémental'
+        elapsed = time.perf_counter() - start
+        print(f"✓ user_stats mis à jour ({mode}) : {refreshed} utilisateurs recalculés en {elapsed:.2f} s")
+        return {'mode': 'full' if full else 'incremental', 'users': refreshed, 'elapsed': elapsed}
+
+    def check_consistency(self, tolerance=1e-6):
+        """Compare user_stats à un recalcul complet depuis transactions (lecture seule)"""
+        print("\nVérification de la cohérence de user_stats...")
+        mismatches = []
+        expected_ids = set()
+
+        def compare(expected_batch):
+            stored_docs = {doc['_id']: doc for doc in
+                           self.collection.find({'_id': {'$in': [doc['_id'] for doc in expected_batch]}})}
+            for expected in expected_batch:
+                stored = stored_docs.get(expected['_id'])
+                if stored is None:
+                    mismatches.append((expected['_id'], 'absent', None))
+                    continue
+                for field in ('transaction_count', 'status_counts', 'last_transaction_at'):
+                    if stored.get(field) != expected.get(field):
+                        mismatches.append((expected['_id'], field, (expected.get(field), stored.get(field))))
+                # Les sommes flottantes dépendent de l'ordre d'addition
+                if abs((stored.get('total_spent') or 0) - (expected.get('total_spent') or 0)) > tolerance:
+                    mismatches.append((expected['_id'], 'total_spent',
+                                       (expected.get('total_spent'), stored.get('total_spent'))))
+
+        batch = []
+        for expected in self.db.transactions.aggregate(build_user_stats_pipeline(), allowDiskUse=True):
+            expected_ids.add(expected['_id'])
+            batch.append(expected)
+            if len(batch) >= self.batch_size:
+                compare(batch)
+                batch = []
+        if batch:
+            compare(batch)
+        for stored in self.collection.find({}, {'_id': 1}):
+            if stored['_id'] not in expected_ids:
+                mismatches.append((stored['_id'], 'en trop', None))
+
+        for user_id, field, values in mismatches[:10]:
+            print(f"  ✗ {user_id}.{field}: {values}")
+        if mismatches:
+            print(f"✗ {len(mismatches)} différences avec le recalcul complet")
+        else:
+            print(f"✓ user_stats est cohérent ({len(expected_ids)} utilisateurs)")
+        return not mismatches